@@ -10,7 +10,7 @@ setuptools.setup(name='simpledataset',
                  long_description=readme_filepath.read_text(),
                  long_description_content_type='text/markdown',
                  packages=setuptools.find_packages(),
-                 install_requires=['pillow', 'requests', 'scipy', 'tenacity', 'tqdm'],
+                 install_requires=['numpy>=1.23', 'pillow', 'requests', 'scipy', 'tenacity', 'tqdm'],
                  license='MIT',
                  url='https://github.com/shonohs/simpledataset',
                  classifiers=[
@@ -29,6 +29,7 @@ setuptools.setup(name='simpledataset',
                          'dataset_filter=simpledataset.commands.filter:main',
                          'dataset_map=simpledataset.commands.map:main',
                          'dataset_pack=simpledataset.commands.pack:main',
+                         'dataset_pipeline=simpledataset.commands.pipeline:main',
                          'dataset_sample=simpledataset.commands.sample:main',
                          'dataset_summary=simpledataset.commands.summary:main'
                      ]})
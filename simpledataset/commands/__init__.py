@@ -0,0 +1,4 @@
+def add_image_mode_argument(parser, description="How to put the images in a new output directory."):
+    parser.add_argument('--image_mode', choices=['copy', 'link', 'reference'], default='copy',
+                        help=(f"{description} copy: copy them into images.zip. link: hardlink or reflink the source files. "
+                              "reference: refer to the source files by relative paths."))
@@ -2,11 +2,15 @@ import argparse
 import collections
 import hashlib
 import pathlib
+import zlib
+import tqdm
 from simpledataset.common import SimpleDatasetFactory, ImageClassificationDataset, ObjectDetectionDataset, VisualRelationshipDataset, DatasetWriter
+from simpledataset.common.file_cache import ImageHashCache
+from simpledataset.common.parallel import imap_ordered
 
 
-def concat_datasets(main_txt_filepaths, output_filepath):
-    datasets = [SimpleDatasetFactory().load(f) for f in main_txt_filepaths]
+def concat_datasets(main_txt_filepaths, output_filepath, use_cache=False, num_workers=1, max_images_per_zip=None, max_zip_size=None):
+    datasets = [SimpleDatasetFactory().load(f, use_cache=use_cache) for f in main_txt_filepaths]
 
     dataset_types = [d.type for d in datasets]
     if len(set(dataset_types)) != 1:
@@ -20,7 +24,7 @@ def concat_datasets(main_txt_filepaths, output_filepath):
     labels = []
     label_id_offset = 0
     annotations = collections.defaultdict(list)
-    image_md5s = {}
+    image_sources = {}
     for dataset in datasets:
         print(f"Concatenating {len(dataset)} images and {len(dataset.labels)} classes.")
         for new_label in dataset.labels:
@@ -40,11 +44,12 @@ def concat_datasets(main_txt_filepaths, output_filepath):
             elif dataset_type == 'visual_relationship':
                 new_labels = [(i[0] + label_id_offset, *i[1:5], i[5] + label_id_offset, *i[6:10], i[10] + label_id_offset) for i in d[1]]
             annotations[new_path].extend(new_labels)
-            if new_path not in image_md5s:
-                image_md5s[new_path] = hashlib.md5(dataset.read_image_binary(d[0])).hexdigest()
+            if new_path not in image_sources:
+                image_sources[new_path] = (dataset, d[0])
         label_id_offset += len(dataset.labels)
 
-    annotations = _dedup_images(annotations, image_md5s)
+    image_hashs = _get_image_hashs(image_sources, num_workers, use_cache)
+    annotations = _dedup_images(annotations, image_hashs)
     data = [(key, annotations[key]) for key in annotations]
 
     if dataset_type == 'image_classification':
@@ -55,10 +60,85 @@ def concat_datasets(main_txt_filepaths, output_filepath):
         dataset = VisualRelationshipDataset(data, directory, label_names=labels)
 
     copy_images = any(f.parent != output_filepath.parent for f in main_txt_filepaths)
-    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images)
+    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images, num_workers=num_workers,
+                          max_images_per_zip=max_images_per_zip, max_zip_size=max_zip_size)
     print(f"Successfully saved {output_filepath}")
 
 
+def _get_image_hashs(image_sources, num_workers, use_cache=False):
+    """Get a hash of each image such that identical images have the same hash.
+
+    Images are bucketed by size. Only the images whose size collides with another image are examined further. The CRC-32
+    of a zip entry is known without reading the image. If a bucket has both zip entries and normal files, the CRC-32 of
+    the normal files is computed so that they are compared with the zip entries. The images whose (size, CRC-32) still
+    collide, and the normal files in a bucket without zip entries, are hashed with MD5. If use_cache is True, the MD5
+    hashes are cached in image_hashes.cache.tsv in each dataset directory, so unchanged images are not hashed again.
+
+    Args:
+        image_sources: dict. image_filepath => (dataset, image_filepath in the dataset).
+    """
+    image_stats = {}
+    buckets = collections.defaultdict(list)
+    for image_path, (dataset, image) in image_sources.items():
+        stat = image_stats[image_path] = dataset.get_image_stat(image)
+        buckets[stat.size].append(image_path)
+
+    image_hashs = {}
+    crcs = {p: image_stats[p].crc for paths in buckets.values() if len(paths) > 1 for p in paths}
+    for size, bucket_paths in buckets.items():
+        if len(bucket_paths) == 1:
+            image_hashs[bucket_paths[0]] = (size, image_stats[bucket_paths[0]].crc)
+
+    # CRC-32 of the normal files that share a size with a zip entry.
+    mixed_paths = [p for paths in buckets.values() if len(paths) > 1 and any(crcs[q] is not None for q in paths) for p in paths if crcs[p] is None]
+    computed_crcs = imap_ordered(lambda p: _compute_crc(*image_sources[p]), mixed_paths, num_workers)
+    for image_path, crc in zip(mixed_paths, tqdm.tqdm(computed_crcs, "Computing CRC-32.", total=len(mixed_paths), disable=None)):
+        crcs[image_path] = crc
+
+    counts = collections.Counter((image_stats[p].size, crc) for p, crc in crcs.items())
+    hash_caches = {}
+    image_paths = []
+    for image_path, crc in crcs.items():
+        image_hash = (image_stats[image_path].size, crc)
+        if crc is not None and counts[image_hash] <= 1:
+            image_hashs[image_path] = image_hash
+            continue
+        dataset, image = image_sources[image_path]
+        if use_cache and dataset not in hash_caches:
+            hash_caches[dataset] = ImageHashCache(dataset.base_images_directory)
+        md5 = use_cache and hash_caches[dataset].get(image, ImageHashCache.get_fingerprint(image_stats[image_path]))
+        if md5:
+            image_hashs[image_path] = md5
+        else:
+            image_paths.append(image_path)
+
+    md5s = imap_ordered(lambda p: _compute_md5(*image_sources[p]), image_paths, num_workers)
+    for image_path, md5 in zip(image_paths, tqdm.tqdm(md5s, "Hashing images.", total=len(image_paths), disable=None)):
+        image_hashs[image_path] = md5
+        if use_cache:
+            dataset, image = image_sources[image_path]
+            hash_caches[dataset].set(image, ImageHashCache.get_fingerprint(image_stats[image_path]), md5)
+
+    for hash_cache in hash_caches.values():
+        hash_cache.save()
+    # Keep the input order since the first image of the duplicates is kept.
+    return {p: image_hashs[p] for p in image_sources}
+
+
+def _compute_crc(dataset, image_filepath):
+    crc = 0
+    for chunk in dataset.read_image_chunks(image_filepath):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _compute_md5(dataset, image_filepath):
+    md5 = hashlib.md5()
+    for chunk in dataset.read_image_chunks(image_filepath):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
 def _dedup_images(annotations, image_hashs):
     """Find duplicated entries and merge them.
     Args:
@@ -101,6 +181,10 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('main_txt_filepath', nargs='+', type=pathlib.Path)
     parser.add_argument('output_filepath', type=pathlib.Path)
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed datasets next to the main txt files, and the image hashes in the images directories, to speed up the next run.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to hash and copy images.")
+    parser.add_argument('--max_images_per_zip', type=int, help="Split the images into images_NNNNN.zip files that have at most this number of images.")
+    parser.add_argument('--max_zip_size', type=int, help="Split the images into images_NNNNN.zip files whose size is at most this number of bytes.")
 
     args = parser.parse_args()
 
@@ -113,7 +197,7 @@ def main():
     if args.output_filepath.exists():
         parser.error(f"{args.output_filepath} already exists.")
 
-    concat_datasets(args.main_txt_filepath, args.output_filepath)
+    concat_datasets(args.main_txt_filepath, args.output_filepath, args.use_cache, args.num_workers, args.max_images_per_zip, args.max_zip_size)
 
 
 if __name__ == '__main__':
@@ -16,7 +16,8 @@ def convert_from(source_format, output_filepath, skip_images, args):
     reader = _READERS[source_format]()
     dataset = reader.read(**vars(args))
 
-    DatasetWriter().write(dataset, output_filepath, copy_images=not skip_images)
+    DatasetWriter().write(dataset, output_filepath, copy_images=not skip_images, num_workers=args.num_workers,
+                          max_images_per_zip=args.max_images_per_zip, max_zip_size=args.max_zip_size)
     print(f"Successfully saved {output_filepath}.")
 
 
@@ -30,6 +31,9 @@ def main():
 
     parser.add_argument('output_filepath', type=pathlib.Path)
     parser.add_argument('--skip_images', action='store_true', help="Do not copy images. Useful when the dataset is too large.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to read images while copying them, and the number of processes to compress label files.")
+    parser.add_argument('--max_images_per_zip', type=int, help="Split the images into images_NNNNN.zip files that have at most this number of images.")
+    parser.add_argument('--max_zip_size', type=int, help="Split the images into images_NNNNN.zip files whose size is at most this number of bytes.")
 
     args = parser.parse_args()
 
@@ -8,10 +8,10 @@ _WRITERS = {'coco': CocoWriter,
 
 
 def convert_to(main_txt_filepath, target_format, output_filepath, args):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=args.use_cache)
 
     if target_format in ['image_classification', 'object_detection', 'visual_relationship']:
-        dataset = TaskConverter().convert(dataset, target_format, output_filepath.parent)
+        dataset = TaskConverter().convert(dataset, target_format, output_filepath.parent, args.num_workers, args.use_cache)
         DatasetWriter().write(dataset, output_filepath)
         print(f"Successfully saved to {output_filepath}")
     elif target_format in _WRITERS:
@@ -35,6 +35,8 @@ def main():
         subparsers.add_parser(c)
 
     parser.add_argument('output_filepath', type=pathlib.Path)
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to load images. For image_classification, also the number of processes to crop images.")
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt, and the image sizes in the images directory, to speed up the next run.")
 
     args = parser.parse_args()
 
@@ -1,58 +1,44 @@
 import argparse
 import pathlib
-from simpledataset.common import SimpleDatasetFactory, DatasetWriter
-
-
-def defrag(main_txt_filepath, output_filepath):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
-    used_labels = set()
-
-    if dataset.type == 'image_classification':
-        for image, labels in dataset:
-            used_labels.update(labels)
-    elif dataset.type == 'object_detection':
-        for image, labels in dataset:
-            used_labels.update([x[0] for x in labels])
-    elif dataset.type == 'visual_relationship':
-        for image, labels in dataset:
-            used_labels.update([x[0] for x in labels])
-            used_labels.update([x[5] for x in labels])
-            used_labels.update([x[10] for x in labels])
-    else:
-        raise RuntimeError
-
-    sorted_used_labels = sorted(list(used_labels))
-    mapping = {i: n for n, i in enumerate(sorted_used_labels)}
+import numpy as np
+from simpledataset.common import SimpleDatasetFactory, DatasetWriter, ClassIdTable
+from simpledataset.commands.map import map_classes
+
+
+def defrag(main_txt_filepath, output_filepath, use_cache=False):
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=use_cache, stream=True)
+    dataset = defrag_classes(dataset)
+    DatasetWriter().write(dataset, output_filepath)
+    print(f"Successfully saved {output_filepath}")
+
+
+def defrag_classes(dataset):
+    """Return a dataset whose class ids are renumbered so that only the used classes remain. A stream is read twice."""
+    counts = np.zeros(0, dtype=np.int64)
+    for store in dataset.iter_annotation_stores():
+        counts = ClassIdTable.count(store.get_columns(dataset.CLASS_COLUMNS), counts)
+
+    sorted_used_labels = np.flatnonzero(counts).tolist()
     print("Here is the plan:")
-    for old_index, new_index in mapping.items():
+    for new_index, old_index in enumerate(sorted_used_labels):
         print(f"{old_index} => {new_index} ({dataset.labels[old_index]})")
 
-    new_label_names = [dataset.labels[sorted_used_labels[i]] for i in range(len(mapping))]
-    if dataset.type == 'image_classification':
-        data = [(image, [mapping.get(x, x) for x in labels]) for image, labels in dataset]
-    elif dataset.type == 'object_detection':
-        data = [(image, [(mapping.get(x[0], x[0]), *x[1:]) for x in labels]) for image, labels in dataset]
-    elif dataset.type == 'visual_relationship':
-        data = [(image, [(mapping.get(x[0], x[0]), *x[1:5], mapping.get(x[5], x[5]), *x[5:10], mapping.get(x[10], x[10])) for x in labels]) for image, labels in dataset]
-    else:
-        raise RuntimeError
-
-    new_dataset = SimpleDatasetFactory().create(dataset.type, data, main_txt_filepath.parent, label_names=new_label_names)
-    DatasetWriter().write(new_dataset, output_filepath)
-    print(f"Successfully saved {output_filepath}")
+    new_label_names = [dataset.labels[i] for i in sorted_used_labels]
+    return map_classes(dataset, ClassIdTable.from_mask(counts > 0), label_names=new_label_names)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('main_txt_filepath', type=pathlib.Path)
     parser.add_argument('output_filepath', type=pathlib.Path)
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
 
     args = parser.parse_args()
 
     if args.output_filepath.exists():
         parser.error(f"{args.output_filepath} already exists.")
 
-    defrag(args.main_txt_filepath, args.output_filepath)
+    defrag(args.main_txt_filepath, args.output_filepath, args.use_cache)
 
 
 if __name__ == '__main__':
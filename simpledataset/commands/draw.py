@@ -1,76 +1,195 @@
 import argparse
+import functools
+import io
+import itertools
 import logging
 import pathlib
+import PIL.Image
 import PIL.ImageDraw
 import tqdm
 from simpledataset.common import SimpleDatasetFactory
+from simpledataset.common.parallel import imap_ordered
 
 
 COLOR_CODES = ["black", "brown", "red", "orange", "yellow", "green", "blue", "violet", "grey", "white"]
 logger = logging.getLogger(__name__)
 
 
-def _draw_od_labels(image, annotations, label_names):
+def _get_label_name(label_names, class_id):
+    # Without labels.txt, the class ids are shown in the same way as the generated class names.
+    return label_names[class_id] if label_names else str(class_id)
+
+
+def _draw_od_labels(image, annotations, label_names, scale=1):
     draw = PIL.ImageDraw.Draw(image)
     for class_id, x, y, x2, y2 in annotations:
+        x, y, x2, y2 = (int(v * scale) for v in (x, y, x2, y2))
         color = COLOR_CODES[class_id % len(COLOR_CODES)]
         draw.rectangle(((x, y), (x2, y2)), outline=color)
-        draw.text((x, y), label_names[class_id])
+        draw.text((x, y), _get_label_name(label_names, class_id))
 
 
-def _draw_ic_labels(image, annotations, label_names):
+def _draw_ic_labels(image, annotations, label_names, scale=1):
     draw = PIL.ImageDraw.Draw(image)
     for i, class_id in enumerate(annotations):
-        draw.text((0, i * 10), label_names[class_id], color='red')
+        draw.text((0, i * 10), _get_label_name(label_names, class_id), color='red')
 
 
-def _draw_vr_labels(image, annotations, label_names):
+def _draw_vr_labels(image, annotations, label_names, scale=1):
     draw = PIL.ImageDraw.Draw(image)
     for subject_id, s_x, s_y, s_x2, s_y2, object_id, o_x, o_y, o_x2, o_y2, predicate_id in annotations:
+        s_x, s_y, s_x2, s_y2, o_x, o_y, o_x2, o_y2 = (int(v * scale) for v in (s_x, s_y, s_x2, s_y2, o_x, o_y, o_x2, o_y2))
         color = COLOR_CODES[object_id % len(COLOR_CODES)]
         draw.rectangle(((o_x, o_y), (o_x2, o_y2)), outline=color)
-        draw.text((o_x, o_y), label_names[object_id])
+        draw.text((o_x, o_y), _get_label_name(label_names, object_id))
 
         color = COLOR_CODES[subject_id % len(COLOR_CODES)]
         draw.rectangle(((s_x, s_y), (s_x2, s_y2)), outline=color)
-        draw.text((s_x, s_y), label_names[subject_id])
+        draw.text((s_x, s_y), _get_label_name(label_names, subject_id))
 
         o_center = ((o_x + o_x2) // 2, (o_y + o_y2) // 2)
         s_center = ((s_x + s_x2) // 2, (s_y + s_y2) // 2)
         draw.line((o_center, s_center), fill=color)
-        draw.text(o_center, label_names[predicate_id])
+        draw.text(o_center, _get_label_name(label_names, predicate_id))
+
+
+_DRAWERS = {'image_classification': _draw_ic_labels,
+            'object_detection': _draw_od_labels,
+            'visual_relationship': _draw_vr_labels}
+
+
+def _render(item, dataset_type, label_names, max_size=None):
+    """Decode an image and draw the annotations. Runs in a worker process.
+
+    Args:
+        item: (image binary, annotations, output filepath). If the output filepath is None, the image is returned.
+        max_size: Downscale the image so that the longer side is at most this number of pixels.
+    """
+    image_binary, annotations, output_filepath = item
+    with io.BytesIO(image_binary) as f:
+        image = PIL.Image.open(f)
+        original_width = image.width
+        if max_size and max(image.size) > max_size:
+            # Let the JPEG decoder skip the resolution that is not needed.
+            image.draft(image.mode, (max_size, max_size))
+            image.load()
+            image.thumbnail((max_size, max_size))
+        else:
+            image.load()
+
+    _DRAWERS[dataset_type](image, annotations, label_names, image.width / original_width)
+    if output_filepath is None:
+        return image
+    image.save(output_filepath)
+    return None
+
+
+def _select_entries(dataset, limit=None, class_ids=None, start=0, end=None):
+    """Yield (image, labels) of the entries in [start, end) that have any of class_ids, up to limit entries.
+
+    Only the entries in the range are parsed from a lazy dataset.
+    """
+    entries = (dataset[i] for i in range(*slice(start, end).indices(len(dataset))))
+    if class_ids:
+        class_ids = set(class_ids)
+        if dataset.type == 'image_classification':
+            entries = (e for e in entries if class_ids.intersection(e[1]))
+        else:
+            entries = (e for e in entries if any(label[c] in class_ids for label in e[1] for c in dataset.CLASS_COLUMNS))
+    return itertools.islice(entries, limit)
+
+
+def draw_dataset(main_txt_filepath, output_dir, use_cache=False, num_workers=1, limit=None, class_ids=None, start=0, end=None, max_size=None, contact_sheet=None):
+    """Draw the annotations into the images and save them to output_dir.
+
+    Args:
+        contact_sheet: (columns, rows). If given, thumbnails of at most max_size pixels are tiled into contact_sheet_NNNNN.jpg.
+    """
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True, use_cache=use_cache)
+    entries = _select_entries(dataset, limit, class_ids, start, end)
+    if contact_sheet:
+        max_size = max_size or 256
+        entries = ((image_filename, annotations, None) for image_filename, annotations in entries)
+    else:
+        entries = _get_output_filepaths(entries, output_dir)
+
+    def read_item(item):
+        # A memoryview of a mapped zip file cannot be sent to the worker processes.
+        image_filename, annotations, output_filepath = item
+        return bytes(dataset.read_image_binary(image_filename)), annotations, output_filepath
+
+    if contact_sheet:
+        entries, captions = itertools.tee(entries)
+        captions = (image_filename.split('@')[-1] for image_filename, _, _ in captions)
+
+    num_entries = len(range(*slice(start, end).indices(len(dataset))))
+    total = None if class_ids else min(num_entries, limit or num_entries)
+    items = imap_ordered(read_item, entries, num_workers)
+    # dataset.labels would parse all the label entries to generate the class names if labels.txt is not found.
+    label_names = dataset.labels if (dataset.base_directory / 'labels.txt').exists() else None
+    render = functools.partial(_render, dataset_type=dataset.type, label_names=label_names, max_size=max_size)
+    images = tqdm.tqdm(imap_ordered(render, items, num_workers, use_processes=True), total=total, disable=None)
+
+    if contact_sheet:
+        _save_contact_sheets(zip(captions, images), output_dir, max_size, *contact_sheet)
+    else:
+        for _ in images:
+            pass
+
+
+def _get_output_filepaths(entries, output_dir):
+    claimed_filepaths = set()
+    for image_filename, annotations in entries:
+        output_filepath = output_dir / image_filename.split('@')[-1]
+        if output_filepath.exists() or output_filepath in claimed_filepaths:
+            logger.warning(f"{output_filepath} already exists. skipping the image...")
+            continue
+        claimed_filepaths.add(output_filepath)
+        output_filepath.parent.mkdir(parents=True, exist_ok=True)
+        yield image_filename, annotations, output_filepath
 
 
-def draw_dataset(main_txt_filepath, output_dir):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
+def _save_contact_sheets(images, output_dir, cell_size, columns, rows):
+    """Tile (caption, image) into sheets of columns x rows cells."""
+    caption_height = 12
+    output_dir.mkdir(parents=True, exist_ok=True)
+    images = iter(images)
+    for sheet_index in itertools.count():
+        tiles = list(itertools.islice(images, columns * rows))
+        if not tiles:
+            break
 
-    drawer = {'image_classification': _draw_ic_labels,
-              'object_detection': _draw_od_labels,
-              'visual_relationship': _draw_vr_labels}[dataset.type]
+        sheet = PIL.Image.new('RGB', (columns * cell_size, rows * (cell_size + caption_height)), 'white')
+        draw = PIL.ImageDraw.Draw(sheet)
+        for i, (caption, image) in enumerate(tiles):
+            x = (i % columns) * cell_size
+            y = (i // columns) * (cell_size + caption_height)
+            sheet.paste(image.convert('RGB'), (x + (cell_size - image.width) // 2, y + (cell_size - image.height) // 2))
+            draw.text((x + 2, y + cell_size), caption, fill='black')
 
-    for image_filename, annotations in tqdm.tqdm(dataset):
-        image = dataset.load_image(image_filename)
-        image_filename = image_filename.split('@')[-1]
-        output_filepath = output_dir / image_filename
-        if output_filepath.exists():
-            logger.warning(f"{output_filepath} already exists. skipping the image...")
-            continue
-        output_filepath.parent.mkdir(parents=True, exist_ok=True)
-        drawer(image, annotations, dataset.labels)
-        image.save(output_filepath)
+        sheet.save(output_dir / f'contact_sheet_{sheet_index:05d}.jpg')
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('main_txt_filepath', type=pathlib.Path)
     parser.add_argument('output_dir', type=pathlib.Path)
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of processes to draw images.")
+    parser.add_argument('--limit', type=int, help="Draw at most this number of images.")
+    parser.add_argument('--class_id', nargs='+', type=int, metavar='CLASS_ID', help="Draw only the images that have any of these classes.")
+    parser.add_argument('--start', type=int, default=0, help="The index of the first image to draw.")
+    parser.add_argument('--end', type=int, help="Draw the images before this index.")
+    parser.add_argument('--max_size', type=int, help="Downscale the images so that the longer side is at most this number of pixels.")
+    parser.add_argument('--contact_sheet', nargs=2, type=int, metavar=('COLUMNS', 'ROWS'),
+                        help="Tile thumbnails into contact_sheet_NNNNN.jpg with this number of columns and rows. The thumbnail size is --max_size (default: 256).")
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
 
     args = parser.parse_args()
 
     if not args.main_txt_filepath.exists():
         parser.error(f"{args.main_txt_filepath} is not found.")
 
-    draw_dataset(args.main_txt_filepath, args.output_dir)
+    draw_dataset(args.main_txt_filepath, args.output_dir, args.use_cache, args.num_workers, args.limit, args.class_id, args.start, args.end, args.max_size, args.contact_sheet)
 
 
 if __name__ == '__main__':
@@ -1,37 +1,63 @@
 import argparse
 import logging
 import pathlib
-from simpledataset.common import SimpleDatasetFactory, DatasetWriter
+from simpledataset.common import SimpleDatasetFactory, DatasetWriter, ClassIdTable
+from simpledataset.commands import add_image_mode_argument
 
 logger = logging.getLogger(__name__)
 
 
-def filter_dataset(main_txt_filepath, output_filepath, include_class_ids, exclude_class_ids):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
-    max_class_id = dataset.get_max_class_id()
-    include_class_ids = set(include_class_ids or [i for i in range(max_class_id + 1) if i not in exclude_class_ids])
+def filter_dataset(main_txt_filepath, output_filepath, include_class_ids, exclude_class_ids, use_cache=False, num_workers=1, image_mode='copy'):
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=use_cache, stream=True)
+    dataset = filter_classes(dataset, include_class_ids, exclude_class_ids)
+    copy_images = main_txt_filepath.parent != output_filepath.parent
+    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images, num_workers=num_workers, image_mode=image_mode)
+    print(f"Successfully saved {output_filepath}")
+
 
-    for c in include_class_ids:
-        if c > max_class_id:
-            logger.warning(f"The class {c} is not in the dataset.")
+def filter_classes(dataset, include_class_ids, exclude_class_ids):
+    """Return a dataset that has only the labels of include_class_ids, or the labels not in exclude_class_ids.
 
-    if dataset.type == 'image_classification':
-        data = [(image, [i for i in labels if i in include_class_ids]) for image, labels in dataset]
-        # Remove images that have no labels.
-        data = [d for d in data if d[1]]
-    elif dataset.type == 'object_detection':
-        data = [(image, [x for x in labels if x[0] in include_class_ids]) for image, labels in dataset]
-        # Remove images that have no labels
-        data = [d for d in data if d[1]]
+    For Classification and Detection, images that have no labels after the filtering are removed. For Visual
+    Relationship, the predicate is filtered. A stream is filtered lazily, and include_class_ids that are not in the
+    dataset are reported once, when the whole stream is filtered for the first time.
+    """
+    if dataset.type in ('image_classification', 'object_detection'):
+        class_column = 0
+        drop_empty_images = True
     elif dataset.type == 'visual_relationship':
-        data = [(image, [x for x in labels if x[10] in include_class_ids]) for image, labels in dataset]
+        class_column = 10
+        drop_empty_images = False
     else:
         raise RuntimeError
 
-    dataset = SimpleDatasetFactory().create(dataset.type, data, main_txt_filepath.parent, label_names=dataset.labels)
-    copy_images = main_txt_filepath.parent != output_filepath.parent
-    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images)
-    print(f"Successfully saved {output_filepath}")
+    if include_class_ids:
+        table = ClassIdTable.from_dict({c: True for c in include_class_ids}, default=False, dtype=bool)
+    else:
+        table = ClassIdTable.from_dict({c: False for c in exclude_class_ids}, default=True, dtype=bool)
+
+    # The max class id is taken from the chunks being filtered so that a stream is not read one more time.
+    max_class_id = 0
+    # Every complete pass gives the same result, so the check is done only for the first one.
+    class_ids_checked = False
+
+    def filter_store(store):
+        nonlocal max_class_id
+        class_ids = store.get_columns(dataset.CLASS_COLUMNS)
+        if class_ids.size:
+            max_class_id = max(max_class_id, int(class_ids.max()))
+        return store.select(table(store.get_columns([class_column])[:, 0]), drop_empty_images=drop_empty_images)
+
+    def check_class_ids():
+        nonlocal max_class_id, class_ids_checked
+        if not class_ids_checked:
+            for c in include_class_ids or []:
+                if c > max_class_id:
+                    logger.warning(f"The class {c} is not in the dataset.")
+            class_ids_checked = True
+        max_class_id = 0
+
+    return dataset.map_annotation_stores(filter_store, label_names=dataset.labels, on_end=check_class_ids)
 
 
 def main():
@@ -41,6 +67,9 @@ def main():
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--include_class', nargs='*', default=[], metavar='CLASS_ID')
     group.add_argument('--exclude_class', nargs='*', default=[], metavar='CLASS_ID')
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to read images while copying them, and the number of processes to compress label files.")
+    add_image_mode_argument(parser)
     args = parser.parse_args()
 
     if args.output_filepath.exists():
@@ -51,7 +80,7 @@ def main():
 
     include_class_ids = [int(c) for c in args.include_class]
     exclude_class_ids = [int(c) for c in args.exclude_class]
-    filter_dataset(args.main_txt_filepath, args.output_filepath, include_class_ids, exclude_class_ids)
+    filter_dataset(args.main_txt_filepath, args.output_filepath, include_class_ids, exclude_class_ids, args.use_cache, args.num_workers, args.image_mode)
 
 
 if __name__ == '__main__':
@@ -1,28 +1,35 @@
 import argparse
 import pathlib
-from simpledataset.common import SimpleDatasetFactory, DatasetWriter
+import numpy as np
+from simpledataset.common import SimpleDatasetFactory, DatasetWriter, ClassIdTable
+from simpledataset.commands import add_image_mode_argument
 
 
-def map_dataset(main_txt_filepath, output_filepath, mappings_list):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
+def map_dataset(main_txt_filepath, output_filepath, mappings_list, use_cache=False, num_workers=1, image_mode='copy'):
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=use_cache, stream=True)
     mappings = {int(src): int(dst) for src, dst in mappings_list}
-
-    if dataset.type == 'image_classification':
-        data = [(image, [mappings.get(x, x) for x in labels if mappings.get(x, x) >= 0]) for image, labels in dataset]
-    elif dataset.type == 'object_detection':
-        data = [(image, [(mappings.get(x[0], x[0]), *x[1:]) for x in labels if mappings.get(x[0], x[0]) >= 0]) for image, labels in dataset]
-    elif dataset.type == 'visual_relationship':
-        data = [(image, [(mappings.get(x[0], x[0]), *x[1:5], mappings.get(x[5], x[5]), *x[6:10], mappings.get(x[10], x[10])) for x in labels]) for image, labels in dataset]
-        data = [(image, [x for x in labels if x[0] >= 0 and x[5] >= 0 and x[10] >= 0]) for image, labels in data]
-    else:
-        raise RuntimeError
-
-    dataset = SimpleDatasetFactory().create(dataset.type, data, main_txt_filepath.parent, label_names=dataset.labels)
+    dataset = map_classes(dataset, mappings)
     copy_images = main_txt_filepath.parent != output_filepath.parent
-    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images)
+    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images, num_workers=num_workers, image_mode=image_mode)
     print(f"Successfully saved {output_filepath}")
 
 
+def map_classes(dataset, mappings, label_names=None):
+    """Return a dataset whose class ids are replaced using the mappings dict or ClassIdTable. Labels mapped to negative
+    ids are removed.
+
+    A stream is mapped lazily. label_names is the class names of the new dataset. The current names are kept if None.
+    """
+    table = mappings if isinstance(mappings, ClassIdTable) else ClassIdTable.from_dict(mappings)
+
+    def map_store(store):
+        class_ids = table(store.get_columns(dataset.CLASS_COLUMNS))
+        # Remove labels that are mapped to negative ids.
+        return store.replace_columns(dataset.CLASS_COLUMNS, class_ids).select(np.all(class_ids >= 0, axis=1))
+
+    return dataset.map_annotation_stores(map_store, label_names=dataset.labels if label_names is None else label_names, keep_length=True)
+
+
 def generate_mapping(src_labels_filepath, dst_labels_filepath):
     print(f"Getting mappings from {src_labels_filepath} to {dst_labels_filepath}")
     src_list = [n for n in src_labels_filepath.read_text().splitlines() if n]
@@ -50,6 +57,9 @@ def main():
     parser.add_argument('output_filepath', type=pathlib.Path)
     parser.add_argument('--map', nargs=2, action='append', metavar=('src_class_id', 'dst_class_id'))
     parser.add_argument('--map_all', nargs=2, type=pathlib.Path, help="Given 2 labels.txt files, update the annotations so that it align with the second labels.txt.")
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to read images while copying them, and the number of processes to compress label files.")
+    add_image_mode_argument(parser)
 
     args = parser.parse_args()
 
@@ -61,7 +71,7 @@ def main():
 
     mappings_list = generate_mapping(args.map_all[0], args.map_all[1]) if args.map_all else args.map
 
-    map_dataset(args.main_txt_filepath, args.output_filepath, mappings_list)
+    map_dataset(args.main_txt_filepath, args.output_filepath, mappings_list, args.use_cache, args.num_workers, args.image_mode)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,25 @@
 import argparse
 import pathlib
-from simpledataset.common import SimpleDatasetFactory, ImageClassificationDataset, ObjectDetectionDataset, VisualRelationshipDataset, DatasetWriter
+import numpy as np
+from simpledataset.common import SimpleDatasetFactory, DatasetWriter
 
 
-def pack(main_txt_filepath, output_filepath, images_directory, keep_empty_images):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath, images_directory=images_directory)
+def pack(main_txt_filepath, output_filepath, images_directory, keep_empty_images, use_cache=False, num_workers=1, max_images_per_zip=None, max_zip_size=None, packed_labels=False, append=False):
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, images_directory=images_directory, use_cache=use_cache, stream=True)
+    if not keep_empty_images:
+        dataset = remove_empty_images(dataset)
 
-    data = [(image, labels) for image, labels in dataset if labels or keep_empty_images]
+    DatasetWriter().write(dataset, output_filepath, copy_images=True, num_workers=num_workers, max_images_per_zip=max_images_per_zip, max_zip_size=max_zip_size,
+                          packed_labels=packed_labels, append=append)
+    print(f"Successfully saved {output_filepath}")
 
-    DATASET_CLASSES = {'image_classification': ImageClassificationDataset,
-                       'object_detection': ObjectDetectionDataset,
-                       'visual_relationship': VisualRelationshipDataset}
-    dataset = DATASET_CLASSES[dataset.type](data, main_txt_filepath.parent, label_names=dataset.labels, images_directory=images_directory)
 
-    DatasetWriter().write(dataset, output_filepath, copy_images=True)
-    print(f"Successfully saved {output_filepath}")
+def remove_empty_images(dataset):
+    """Return a dataset without the images that have no labels. A stream is processed lazily."""
+    def remove(store):
+        return store.select(np.ones(len(store.annotations), dtype=bool), drop_empty_images=True)
+
+    return dataset.map_annotation_stores(remove, label_names=dataset.labels)
 
 
 def main():
@@ -23,10 +28,17 @@ def main():
     parser.add_argument('output_filepath', type=pathlib.Path)
     parser.add_argument('--images_dir', type=pathlib.Path, help="Directory from which load images.")
     parser.add_argument('--keep_empty_images', action='store_true', help="Keep images that don't have annotations.")
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to read images while copying them, and the number of processes to compress label files.")
+    parser.add_argument('--max_images_per_zip', type=int, help="Split the images into images_NNNNN.zip files that have at most this number of images.")
+    parser.add_argument('--max_zip_size', type=int, help="Split the images into images_NNNNN.zip files whose size is at most this number of bytes.")
+    parser.add_argument('--packed_labels', action='store_true', help="Save Object Detection/Visual Relationship labels into a single labels.npz instead of labels.zip.")
+    parser.add_argument('--append', action='store_true', help="Add the images and labels to the existing dataset at output_filepath without rewriting it.")
 
     args = parser.parse_args()
     images_dir = args.images_dir or args.main_txt_filepath.parent
-    pack(args.main_txt_filepath, args.output_filepath, images_dir, args.keep_empty_images)
+    pack(args.main_txt_filepath, args.output_filepath, images_dir, args.keep_empty_images, args.use_cache, args.num_workers,
+         args.max_images_per_zip, args.max_zip_size, args.packed_labels, args.append)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+import argparse
+import pathlib
+import shlex
+from simpledataset.common import SimpleDatasetFactory, DatasetWriter
+from simpledataset.commands import add_image_mode_argument
+from simpledataset.commands.defrag import defrag_classes
+from simpledataset.commands.filter import filter_classes
+from simpledataset.commands.map import generate_mapping, map_classes
+from simpledataset.commands.pack import remove_empty_images
+from simpledataset.commands.sample import sample_images
+
+
+def _make_operation_parsers():
+    parsers = {}
+
+    parser = parsers['filter'] = argparse.ArgumentParser(prog='filter')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--include_class', nargs='+', type=int, default=[], metavar='CLASS_ID')
+    group.add_argument('--exclude_class', nargs='+', type=int, default=[], metavar='CLASS_ID')
+
+    parser = parsers['map'] = argparse.ArgumentParser(prog='map')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--map', nargs=2, action='append', metavar=('src_class_id', 'dst_class_id'))
+    group.add_argument('--map_all', nargs=2, type=pathlib.Path, help="Given 2 labels.txt files, update the annotations so that it align with the second labels.txt.")
+
+    parsers['defrag'] = argparse.ArgumentParser(prog='defrag')
+
+    parser = parsers['sample'] = argparse.ArgumentParser(prog='sample')
+    parser.add_argument('--num_images', '-n', default=100, type=int)
+    parser.add_argument('--seed', type=int)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--stratify', action='store_true')
+    group.add_argument('--reservoir', action='store_true')
+
+    parser = parsers['pack'] = argparse.ArgumentParser(prog='pack')
+    parser.add_argument('--keep_empty_images', action='store_true', help="Keep images that don't have annotations.")
+    parser.add_argument('--max_images_per_zip', type=int, help="Split the images into images_NNNNN.zip files that have at most this number of images.")
+    parser.add_argument('--max_zip_size', type=int, help="Split the images into images_NNNNN.zip files whose size is at most this number of bytes.")
+    parser.add_argument('--packed_labels', action='store_true', help="Save Object Detection/Visual Relationship labels into a single labels.npz instead of labels.zip.")
+
+    return parsers
+
+
+def run_pipeline(main_txt_filepath, output_filepath, operations, use_cache=False, num_workers=1, image_mode='copy', packed_labels=False):
+    """Apply the operations to the dataset as a stream and write the result once.
+
+    Args:
+        operations: A list of (operation name, argparse.Namespace). 'pack' must be the last operation if it's given.
+            Without operations, the dataset is only rewritten, e.g. to change the label layout with packed_labels.
+        packed_labels (bool): Save Object Detection/Visual Relationship labels into a single labels.npz.
+    """
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=use_cache, stream=True)
+    copy_images = main_txt_filepath.parent != output_filepath.parent
+    write_args = {'packed_labels': packed_labels}
+
+    for name, args in operations:
+        if name == 'filter':
+            dataset = filter_classes(dataset, args.include_class, args.exclude_class)
+        elif name == 'map':
+            mappings_list = generate_mapping(args.map_all[0], args.map_all[1]) if args.map_all else args.map
+            dataset = map_classes(dataset, {int(src): int(dst) for src, dst in mappings_list})
+        elif name == 'defrag':
+            dataset = defrag_classes(dataset)
+        elif name == 'sample':
+            dataset = sample_images(dataset, args.num_images, args.seed, args.stratify, args.reservoir)
+        elif name == 'pack':
+            if not args.keep_empty_images:
+                dataset = remove_empty_images(dataset)
+            copy_images = True
+            image_mode = 'copy'
+            write_args = {'max_images_per_zip': args.max_images_per_zip, 'max_zip_size': args.max_zip_size, 'packed_labels': args.packed_labels or packed_labels}
+        else:
+            raise ValueError(f"Unknown operation: {name}")
+
+    DatasetWriter().write(dataset, output_filepath, copy_images=copy_images, num_workers=num_workers, image_mode=image_mode, **write_args)
+    print(f"Successfully saved {output_filepath}")
+
+
+def main():
+    operation_parsers = _make_operation_parsers()
+    parser = argparse.ArgumentParser(description="Run multiple operations on a dataset in one pass and write the result once.",
+                                     epilog='Example: dataset_pipeline images.txt out/images.txt "filter --include_class 1 2" "map --map_all labels.txt new_labels.txt" defrag pack')
+    parser.add_argument('main_txt_filepath', type=pathlib.Path)
+    parser.add_argument('output_filepath', type=pathlib.Path)
+    parser.add_argument('operations', nargs='*', metavar='OPERATION', help=f"An operation and its arguments in a string. One of {', '.join(operation_parsers)}.")
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to read images while copying them, and the number of processes to compress label files.")
+    add_image_mode_argument(parser, "How to put the images in a new output directory if pack is not given.")
+    parser.add_argument('--packed_labels', action='store_true',
+                        help="Save Object Detection/Visual Relationship labels into a single labels.npz instead of labels.zip. Combined with --image_mode reference, only the labels are rewritten.")
+
+    args = parser.parse_args()
+
+    if args.output_filepath.exists():
+        parser.error(f"{args.output_filepath} already exists.")
+
+    operations = []
+    for operation in args.operations:
+        tokens = shlex.split(operation)
+        if not tokens or tokens[0] not in operation_parsers:
+            parser.error(f"Unknown operation: {operation}")
+        operations.append((tokens[0], operation_parsers[tokens[0]].parse_args(tokens[1:])))
+
+    if any(name == 'pack' for name, _ in operations[:-1]):
+        parser.error("pack must be the last operation.")
+
+    run_pipeline(args.main_txt_filepath, args.output_filepath, operations, args.use_cache, args.num_workers, args.image_mode, args.packed_labels)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,152 @@
 import argparse
 import pathlib
-import random
-from simpledataset.common import SimpleDatasetFactory, DatasetWriter
+import numpy as np
+from simpledataset.common import AnnotationStream, ClassIdTable, SimpleDatasetFactory, DatasetWriter
+from simpledataset.commands import add_image_mode_argument
 
 
-def sample(main_txt_filepath, output_filepath, num_images):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
+def sample(main_txt_filepath, output_filepath, num_images, use_cache=False, num_workers=1, image_mode='copy', seed=None, stratify=False, reservoir=False):
+    if reservoir:
+        dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=use_cache, stream=True)
+    else:
+        dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True, use_cache=use_cache)
 
-    if num_images >= len(dataset):
-        print(f"Request {num_images} samples, but the dataset has only {len(dataset)} samples.")
+    new_dataset = sample_images(dataset, num_images, seed, stratify, reservoir)
+    if new_dataset is dataset:
+        print(f"Request {num_images} samples, but the dataset doesn't have more samples.")
         return
 
-    data = []
-    sampled_indexes = random.sample(range(len(dataset)), num_images)
-    for i, d in enumerate(dataset):
-        if i in sampled_indexes:
-            data.append(d)
-
-    new_dataset = SimpleDatasetFactory().create(dataset.type, data, main_txt_filepath.parent, dataset.labels)
     copy_images = main_txt_filepath.parent != output_filepath.parent
-    DatasetWriter().write(new_dataset, output_filepath, copy_images=copy_images)
+    DatasetWriter().write(new_dataset, output_filepath, copy_images=copy_images, num_workers=num_workers, image_mode=image_mode)
     print(f"Successfully saved {output_filepath}")
 
 
+def sample_images(dataset, num_images, seed=None, stratify=False, reservoir=False):
+    """Return a dataset with num_images images randomly selected in the original order.
+
+    Only the selected entries are parsed from a lazy dataset. A stream is filtered lazily chunk by chunk. If the length
+    of the stream is unknown, e.g. after filtering, it's counted first. With reservoir=True, the dataset is read only
+    once and the sampled entries are kept in memory instead. With stratify=True, each image is assigned to the rarest
+    class in it, and the classes are sampled in proportion to their number of images. The dataset is returned as it is
+    if it doesn't have more than num_images images.
+    """
+    if stratify and reservoir:
+        raise ValueError("Stratified sampling is not supported with reservoir sampling.")
+
+    rng = np.random.default_rng(seed)
+    if reservoir:
+        return _sample_reservoir(dataset, num_images, rng)
+
+    if stratify:
+        strata = _get_strata(dataset)
+        num_total_images = len(strata)
+    else:
+        try:
+            num_total_images = len(dataset)
+        except TypeError:
+            num_total_images = sum(len(store) for store in dataset.iter_annotation_stores())
+
+    if num_images >= num_total_images:
+        return dataset
+
+    if stratify:
+        sampled_indexes = np.sort(_choice_stratified(strata, num_images, rng))
+    else:
+        sampled_indexes = np.sort(rng.choice(num_total_images, num_images, replace=False))
+
+    if not dataset.is_stream:
+        data = [dataset[i] for i in sampled_indexes.tolist()]
+        return SimpleDatasetFactory().create(dataset.type, data, dataset.base_directory, dataset.labels, dataset.base_images_directory)
+
+    def take_sampled(stores):
+        start = 0
+        for store in stores:
+            indexes = sampled_indexes[(sampled_indexes >= start) & (sampled_indexes < start + len(store))]
+            yield store.take(indexes - start)
+            start += len(store)
+
+    stream = AnnotationStream(lambda: take_sampled(dataset.iter_annotation_stores()), num_images)
+    return SimpleDatasetFactory().create(dataset.type, stream, dataset.base_directory, dataset.labels, dataset.base_images_directory)
+
+
+def _sample_reservoir(dataset, num_images, rng):
+    """Sample in one pass over the dataset with reservoir sampling."""
+    reservoir = []  # (index, image, labels)
+    num_seen = 0
+    for store in dataset.iter_annotation_stores():
+        num_filled = max(0, min(len(store), num_images - num_seen))
+        reservoir.extend((num_seen + i, *store[i]) for i in range(num_filled))
+        if len(store) > num_filled:
+            # The i-th entry replaces a random slot with the probability num_images / (i + 1).
+            indexes = np.arange(num_seen + num_filled, num_seen + len(store))
+            slots = rng.integers(0, indexes + 1)
+            for i in np.flatnonzero(slots < num_images).tolist():
+                reservoir[slots[i]] = (indexes[i], *store[num_filled + i])
+        num_seen += len(store)
+
+    if num_images >= num_seen:
+        return dataset
+
+    data = [(image, labels) for _, image, labels in sorted(reservoir, key=lambda x: x[0])]
+    return SimpleDatasetFactory().create(dataset.type, data, dataset.base_directory, dataset.labels, dataset.base_images_directory)
+
+
+def _get_strata(dataset):
+    """Get the rarest class id of each image. Images without labels get -1."""
+    class_column = 10 if dataset.type == 'visual_relationship' else 0
+    # A lazy dataset is parsed into a store only once. A stream is read twice chunk by chunk.
+    stores = None if dataset.is_stream else [dataset.get_annotation_store()]
+    counts = np.zeros(0, dtype=np.int64)
+    for store in stores or dataset.iter_annotation_stores():
+        counts = ClassIdTable.count(store.get_columns([class_column]), counts)
+
+    strata = []
+    for store in stores or dataset.iter_annotation_stores():
+        class_ids = store.get_columns([class_column])[:, 0].astype(np.int64)
+        # Sort key of each label. The rarest class comes first, and the smaller class id wins a tie.
+        keys = counts[class_ids] * len(counts) + class_ids
+        num_labels = store.get_num_annotations_per_image()
+        store_strata = np.full(len(store), -1, dtype=np.int64)
+        has_labels = num_labels > 0
+        if has_labels.any():
+            store_strata[has_labels] = np.minimum.reduceat(keys, store.offsets[:-1][has_labels]) % len(counts)
+        strata.append(store_strata)
+
+    return np.concatenate(strata) if strata else np.zeros(0, dtype=np.int64)
+
+
+def _choice_stratified(strata, num_images, rng):
+    """Choose num_images indexes so that each stratum gets a share proportional to its size."""
+    stratum_ids, inverse, sizes = np.unique(strata, return_inverse=True, return_counts=True)
+    shares = sizes * num_images / len(strata)
+    num_samples = np.floor(shares).astype(np.int64)
+    # Give the remaining samples to the strata with the largest fractions.
+    remaining = num_images - num_samples.sum()
+    num_samples[np.argsort(num_samples - shares, kind='stable')[:remaining]] += 1
+
+    indexes_by_stratum = np.split(np.argsort(inverse, kind='stable'), np.cumsum(sizes)[:-1])
+    return np.concatenate([rng.choice(indexes, n, replace=False) for indexes, n in zip(indexes_by_stratum, num_samples)])
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('main_txt_filepath', type=pathlib.Path)
     parser.add_argument('output_filepath', type=pathlib.Path)
     parser.add_argument('--num_images', '-n', default=100, type=int)
+    parser.add_argument('--seed', type=int, help="Random seed to make the sampling reproducible.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--stratify', action='store_true', help="Sample each class in proportion to its number of images. Each image belongs to the rarest class in it.")
+    group.add_argument('--reservoir', action='store_true', help="Read the dataset only once as a stream and keep the samples in memory.")
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
+    parser.add_argument('--num_workers', type=int, default=1, help="The number of threads to read images while copying them, and the number of processes to compress label files.")
+    add_image_mode_argument(parser)
 
     args = parser.parse_args()
 
     if args.output_filepath.exists():
         parser.error(f"{args.output_filepath} already exists.")
 
-    sample(args.main_txt_filepath, args.output_filepath, args.num_images)
+    sample(args.main_txt_filepath, args.output_filepath, args.num_images, args.use_cache, args.num_workers, args.image_mode, args.seed, args.stratify, args.reservoir)
 
 
 if __name__ == '__main__':
@@ -1,30 +1,20 @@
 import argparse
-import collections
 import pathlib
+import numpy as np
 from simpledataset.common import SimpleDatasetFactory
 
 
-def print_summary(main_txt_filepath):
-    dataset = SimpleDatasetFactory().load(main_txt_filepath)
-    num_class_samples = collections.Counter()
+def print_summary(main_txt_filepath, use_cache=False):
+    dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=use_cache)
     additional_summaries = []
 
-    if dataset.type == 'image_classification':
-        for image, labels in dataset:
-            num_class_samples.update(labels)
-    elif dataset.type == 'object_detection':
-        max_num_boxes_per_image = 0
-        for image, labels in dataset:
-            num_class_samples.update(x[0] for x in labels)
-            max_num_boxes_per_image = max(max_num_boxes_per_image, len(labels))
+    if dataset.type == 'object_detection':
+        num_boxes = dataset.get_annotation_store().get_num_annotations_per_image()
+        max_num_boxes_per_image = int(num_boxes.max()) if len(num_boxes) else 0
         additional_summaries.append(f"The max number of boxes per image: {max_num_boxes_per_image}")
-    elif dataset.type == 'visual_relationship':
-        for image, labels in dataset:
-            num_class_samples.update(x[0] for x in labels)
-            num_class_samples.update(x[5] for x in labels)
-            num_class_samples.update(x[10] for x in labels)
-    else:
-        raise RuntimeError
+
+    class_ids, counts = np.unique(dataset.get_class_ids(), return_counts=True)
+    num_class_samples = dict(zip(class_ids.tolist(), counts.tolist()))
 
     print(f"The dataset type: {dataset.type}")
     print(f"The number of images: {len(dataset)}")
@@ -43,12 +33,13 @@ def print_summary(main_txt_filepath):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('main_txt_filepath', type=pathlib.Path)
+    parser.add_argument('--use_cache', action='store_true', help="Cache the parsed dataset next to the main txt to speed up the next load.")
 
     args = parser.parse_args()
     if not args.main_txt_filepath.exists():
         parser.error(f"Cannot find {args.main_txt_filepath}")
 
-    print_summary(args.main_txt_filepath)
+    print_summary(args.main_txt_filepath, args.use_cache)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,7 @@
+from .annotation_store import AnnotationStore
+from .annotation_stream import AnnotationStream
+from .class_id_table import ClassIdTable
 from .dataset import SimpleDatasetFactory, ImageClassificationDataset, ObjectDetectionDataset, VisualRelationshipDataset
 from .dataset_writer import DatasetWriter
 
-__all__ = ['SimpleDatasetFactory', 'ImageClassificationDataset', 'ObjectDetectionDataset', 'VisualRelationshipDataset', 'DatasetWriter']
+__all__ = ['AnnotationStore', 'AnnotationStream', 'ClassIdTable', 'SimpleDatasetFactory', 'ImageClassificationDataset', 'ObjectDetectionDataset', 'VisualRelationshipDataset', 'DatasetWriter']
@@ -0,0 +1,146 @@
+import array
+import numpy as np
+
+
+class AnnotationStore:
+    """Columnar storage for a list of (image, labels).
+
+    The annotations of all images are kept in one contiguous int32 array. The labels of the i-th image are
+    annotations[offsets[i]:offsets[i + 1]]. The array is 1-D for Image Classification (class ids), and N x 5 or N x 11
+    for Object Detection and Visual Relationship. Iterating a store yields the same (image, labels) pairs as a list.
+    """
+    def __init__(self, images, offsets, annotations):
+        assert len(offsets) == len(images) + 1
+        assert offsets[-1] == len(annotations)
+        self._images = images
+        self._offsets = offsets
+        self._annotations = annotations
+
+    @classmethod
+    def from_list(cls, data, num_columns):
+        builder = AnnotationStoreBuilder(num_columns)
+        for image, labels in data:
+            builder.append(image, labels)
+        return builder.build()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __iter__(self):
+        for i in range(len(self._images)):
+            yield self._get(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index out of range: {index}")
+        return self._get(index)
+
+    def _get(self, index):
+        labels = self._annotations[self._offsets[index]:self._offsets[index + 1]].tolist()
+        if self._annotations.ndim > 1:
+            labels = [tuple(x) for x in labels]
+        return (self._images[index], labels)
+
+    @property
+    def images(self):
+        return self._images
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def annotations(self):
+        return self._annotations
+
+    def get_num_annotations_per_image(self):
+        return np.diff(self._offsets)
+
+    def get_columns(self, columns):
+        """Get a (num_annotations x len(columns)) array. A 1-D annotations array is treated as a single column."""
+        return self._as_2d(self._annotations)[:, columns]
+
+    def replace_columns(self, columns, values):
+        """Return a new store whose columns are replaced with the given (num_annotations x len(columns)) values."""
+        annotations = self._annotations.copy()
+        self._as_2d(annotations)[:, columns] = values
+        return AnnotationStore(self._images, self._offsets, annotations)
+
+    @staticmethod
+    def _as_2d(annotations):
+        # reshape(len, -1) cannot be used since it fails for an empty array.
+        return annotations[:, np.newaxis] if annotations.ndim == 1 else annotations
+
+    def select(self, annotation_mask, drop_empty_images=False):
+        """Return a new store that has only the annotations where annotation_mask is True.
+
+        Args:
+            annotation_mask: A boolean array with one element per annotation.
+            drop_empty_images (bool): Remove images that have no annotations after the selection.
+        """
+        assert len(annotation_mask) == len(self._annotations)
+        annotations = self._annotations[annotation_mask]
+        # The number of selected annotations before each offset.
+        offsets = np.concatenate(([0], np.cumsum(annotation_mask, dtype=np.int64)))[self._offsets]
+        images = self._images
+        if drop_empty_images:
+            image_indexes = np.flatnonzero(np.diff(offsets) > 0)
+            images = [images[i] for i in image_indexes]
+            offsets = np.append(offsets[image_indexes], offsets[-1])
+        return AnnotationStore(images, offsets, annotations)
+
+    def take(self, image_indexes):
+        """Return a new store that has only the images at the given indexes, in that order."""
+        image_indexes = np.asarray(image_indexes, dtype=np.int64)
+        starts = self._offsets[image_indexes]
+        counts = self._offsets[image_indexes + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        # The index of each selected annotation: its start plus its position in the image.
+        annotation_indexes = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return AnnotationStore([self._images[i] for i in image_indexes], offsets, self._annotations[annotation_indexes])
+
+    @classmethod
+    def concatenate(cls, stores, num_columns):
+        """Concatenate stores into one store. num_columns is used only if there is no store."""
+        stores = list(stores)
+        if not stores:
+            return AnnotationStoreBuilder(num_columns).build()
+        images = [image for store in stores for image in store.images]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for store in stores:
+            offsets.append(store.offsets[1:] - store.offsets[0] + offsets[-1][-1])
+        return AnnotationStore(images, np.concatenate(offsets), np.concatenate([store.annotations for store in stores]))
+
+
+class AnnotationStoreBuilder:
+    """Build an AnnotationStore incrementally without keeping the labels as Python objects."""
+    def __init__(self, num_columns=None):
+        self._num_columns = num_columns
+        self._images = []
+        self._offsets = array.array('q', [0])
+        self._annotations = array.array('i')
+
+    def append(self, image, labels):
+        if isinstance(labels, np.ndarray):
+            assert labels.shape[1:] == ((self._num_columns,) if self._num_columns else ()), f"Invalid labels shape: {labels.shape}"
+            self._annotations.frombytes(labels.astype(np.int32).tobytes())
+        elif self._num_columns:
+            for label in labels:
+                assert len(label) == self._num_columns, f"Invalid label: {label}"
+                self._annotations.extend(label)
+        else:
+            self._annotations.extend(labels)
+        self._images.append(image)
+        self._offsets.append(self._offsets[-1] + len(labels))
+
+    def build(self):
+        offsets = np.frombuffer(self._offsets, dtype=np.int64)
+        annotations = np.frombuffer(self._annotations, dtype=np.int32)
+        if self._num_columns:
+            annotations = annotations.reshape(-1, self._num_columns)
+        return AnnotationStore(self._images, offsets, annotations)
@@ -0,0 +1,37 @@
+class AnnotationStream:
+    """Iterable of (image, labels) that is produced chunk by chunk on each iteration.
+
+    chunks_func returns a new iterator of AnnotationStore chunks. Since a chunk is dropped once it is consumed, the
+    memory usage doesn't depend on the dataset size. Transformations are applied to each chunk with map_chunks(), and
+    they run only when the stream is iterated, e.g. by DatasetWriter.
+    """
+    def __init__(self, chunks_func, length=None):
+        self._chunks_func = chunks_func
+        self._length = length
+
+    def __len__(self):
+        if self._length is None:
+            raise TypeError("The length of the stream is unknown.")
+        return self._length
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self):
+        return iter(self._chunks_func())
+
+    def map_chunks(self, func, keep_length=False, on_end=None):
+        """Return a new stream that applies func to each AnnotationStore chunk.
+
+        Args:
+            keep_length (bool): func doesn't change the number of images.
+            on_end (callable): Called without arguments after the last chunk of each complete iteration.
+        """
+        def chunks_func():
+            for chunk in self.iter_chunks():
+                yield func(chunk)
+            if on_end:
+                on_end()
+
+        return AnnotationStream(chunks_func, self._length if keep_length else None)
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class ClassIdTable:
+    """Dense lookup table indexed by class id. Applied to an array of class ids at once.
+
+    Class ids outside of the table get the default value. If the default is None, they are kept as they are.
+    """
+    def __init__(self, table, default=None):
+        self._table = np.asarray(table)
+        self._default = default
+
+    @classmethod
+    def from_dict(cls, values, default=None, dtype=np.int32):
+        """Create a table from {class_id: value}. If default is None, the other class ids are mapped to themselves."""
+        if any(i < 0 for i in values):
+            raise ValueError(f"Class ids must be non-negative: {sorted(values)}")
+
+        size = max(values) + 1 if values else 0
+        table = np.arange(size, dtype=dtype) if default is None else np.full(size, default, dtype=dtype)
+        if values:
+            table[np.fromiter(values.keys(), dtype=np.int64, count=len(values))] = np.fromiter(values.values(), dtype=dtype, count=len(values))
+        return cls(table, default)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Renumber the class ids where mask is True to 0, 1, 2, ... The other class ids are mapped to -1."""
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.where(mask, np.cumsum(mask) - 1, -1).astype(np.int32), -1)
+
+    def __call__(self, class_ids):
+        class_ids = np.asarray(class_ids)
+        if class_ids.size and class_ids.min() >= 0 and class_ids.max() < len(self._table):
+            return self._table[class_ids]
+
+        in_range = (class_ids >= 0) & (class_ids < len(self._table))
+        results = class_ids.astype(self._table.dtype) if self._default is None else np.full(class_ids.shape, self._default, dtype=self._table.dtype)
+        results[in_range] = self._table[class_ids[in_range]]
+        return results
+
+    @staticmethod
+    def count(class_ids, counts):
+        """Add the number of occurrences of each class id to counts. Returns the counts, extended as needed."""
+        new_counts = np.bincount(np.asarray(class_ids).ravel())
+        if len(counts) < len(new_counts):
+            counts, new_counts = new_counts, counts
+        counts[:len(new_counts)] += new_counts
+        return counts
@@ -1,22 +1,34 @@
+import collections
 import io
 import logging
 import pathlib
+import numpy as np
 import PIL.Image
+from .annotation_store import AnnotationStore, AnnotationStoreBuilder
+from .annotation_stream import AnnotationStream
+from .dataset_cache import DatasetCache
 from .dataset_type_detector import DatasetTypeDetector
 from .file_reader import FileReader
+from .image_size import ImageSizeCache, get_image_size
+from .packed_label_file import PackedLabelFile
+from .parallel import imap_ordered
 
 logger = logging.getLogger(__name__)
 
 
 class ImageDataset:
-    # This variable must be overwritten by a child class.
+    # These variables must be overwritten by a child class.
     LABEL_LOADER_CLASS = None
+    NUM_COLUMNS = None  # The number of integers in a label. None if a label is a single class id.
+    CLASS_COLUMNS = None  # Indexes of the class ids in a label.
 
     def __init__(self, data, directory, label_names=None, images_directory=None):
-        assert isinstance(data, list)
-        if data:
-            assert len(data[0]) == 2
-            assert isinstance(data[0][0], str)
+        assert isinstance(data, (list, LazyAnnotations, AnnotationStore, AnnotationStream))
+        if isinstance(data, list):
+            if data:
+                assert len(data[0]) == 2
+                assert isinstance(data[0][0], str)
+            data = AnnotationStore.from_list(data, self.NUM_COLUMNS)
 
         self._data = data
         self._directory = directory
@@ -26,23 +38,69 @@ class ImageDataset:
         self._image_reader = FileReader(self._images_directory)
 
     @classmethod
-    def load(cls, main_txt, directory, images_dir):
-        data = []
+    def load(cls, main_txt, directory, images_dir, lazy=False):
+        label_loader = cls.LABEL_LOADER_CLASS(directory)
+        if lazy:
+            return cls(LazyAnnotations.load(main_txt, label_loader), directory, images_directory=images_dir)
+
+        builder = AnnotationStoreBuilder(cls.NUM_COLUMNS)
+        for line in main_txt.splitlines():
+            cls._append_line(builder, label_loader, line)
+        return cls(builder.build(), directory, images_directory=images_dir)
+
+    @classmethod
+    def load_stream(cls, main_txt_filepath, directory, images_dir, chunk_size=10000, create_cache_writer=None):
+        """Load a dataset whose annotations are read from the main txt chunk by chunk on each iteration.
 
+        If create_cache_writer is given, the chunks are added to a DatasetCacheWriter it returns until an iteration is
+        completed, so that the cache is saved without keeping the chunks in memory.
+        """
         label_loader = cls.LABEL_LOADER_CLASS(directory)
+
+        def read_chunks():
+            nonlocal create_cache_writer
+            cache_writer = create_cache_writer() if create_cache_writer else None
+            try:
+                builder = AnnotationStoreBuilder(cls.NUM_COLUMNS)
+                with open(main_txt_filepath) as f:
+                    for i, line in enumerate(f, 1):
+                        cls._append_line(builder, label_loader, line)
+                        if i % chunk_size == 0:
+                            store = builder.build()
+                            if cache_writer:
+                                cache_writer.add(store)
+                            yield store
+                            builder = AnnotationStoreBuilder(cls.NUM_COLUMNS)
+                store = builder.build()
+                if cache_writer:
+                    cache_writer.add(store)
+                    cache_writer.close()
+                    create_cache_writer = None
+                yield store
+            finally:
+                # The cache is not saved if the iteration is stopped in the middle.
+                if cache_writer:
+                    cache_writer.abort()
+
+        with open(main_txt_filepath) as f:
+            num_images = sum(1 for _ in f)
+        return cls(AnnotationStream(read_chunks, num_images), directory, images_directory=images_dir)
+
+    @staticmethod
+    def _append_line(builder, label_loader, line):
         try:
-            line = ''
-            for line in main_txt.splitlines():
-                fields = line.strip().split(maxsplit=1)
-                image_path = fields[0]
-                labels = label_loader.load(fields[1]) if len(fields) > 1 else []
-                data.append((image_path, labels))
+            fields = line.strip().split(maxsplit=1)
+            image_path = fields[0]
+            if len(fields) > 1 and PackedLabelFile.is_packed_label(fields[1]):
+                # Append the numpy array as it is without converting it to tuples.
+                builder.append(image_path, label_loader.load_packed(fields[1]))
+                return
+            labels = label_loader.load(fields[1]) if len(fields) > 1 else []
+            builder.append(image_path, labels)
         except Exception:
-            print(f"Failed to parse '{line}'")
+            print(f"Failed to parse '{line.strip()}'")
             raise
 
-        return cls(data, directory, images_directory=images_dir)
-
     def __iter__(self):
         for d in self._data:
             yield d
@@ -59,6 +117,48 @@ class ImageDataset:
             image.load()
             return image
 
+    def load_images(self, image_filenames, num_workers=1):
+        """Load images on a thread pool and yield them in the given order.
+
+        Reading and decoding of the following images overlap with the processing of the yielded image.
+        """
+        return imap_ordered(self.load_image, image_filenames, num_workers)
+
+    def read_image_raw(self, image_filename):
+        """Returns (ZipInfo, compressed data) of an image in a zip file, or None. Used to copy an image without recompression."""
+        return self._image_reader.read_raw(image_filename)
+
+    def read_image_chunks(self, image_filename, chunk_size=1024 * 1024):
+        return self._image_reader.read_chunks(image_filename, chunk_size)
+
+    def get_image_stat(self, image_filename):
+        """Get the size of the image file, and the CRC-32 if the image is in a zip file, without reading the image."""
+        return self._image_reader.get_stat(image_filename)
+
+    def get_image_sizes(self, image_filenames, num_workers=1, use_cache=False):
+        """Get a list of (width, height) of the images by parsing only their headers.
+
+        If use_cache is True, the sizes are persisted in the images directory and reused as long as the images are not modified.
+        """
+        cache = ImageSizeCache(self._images_directory) if use_cache else None
+
+        def get_size(image_filename):
+            if cache:
+                fingerprint = ImageSizeCache.get_fingerprint(self.get_image_stat(image_filename))
+                size = cache.get(image_filename, fingerprint)
+                if size:
+                    return size
+
+            size = get_image_size(self.read_image_binary(image_filename))
+            if cache:
+                cache.set(image_filename, fingerprint, size)
+            return size
+
+        sizes = list(imap_ordered(get_size, image_filenames, num_workers))
+        if cache:
+            cache.save()
+        return sizes
+
     def read_image_binary(self, image_filename):
         return self._image_reader.read(image_filename, 'rb')
 
@@ -71,14 +171,59 @@ class ImageDataset:
             labels = [str(i) for i in range(self.get_max_class_id() + 1)]
 
         assert len(labels) == len(set(labels))
-        assert len(labels) >= self.get_max_class_id()
+        # A stream or a lazy dataset is not validated here since it would need to parse all the label entries.
+        if not isinstance(self._data, (AnnotationStream, LazyAnnotations)):
+            assert len(labels) >= self.get_max_class_id()
         return labels
 
+    def get_annotation_store(self):
+        """Get the annotations as an AnnotationStore. A lazy dataset or a stream is fully loaded into a new store."""
+        if isinstance(self._data, AnnotationStore):
+            return self._data
+        if isinstance(self._data, AnnotationStream):
+            return AnnotationStore.concatenate(self._data.iter_chunks(), self.NUM_COLUMNS)
+        return AnnotationStore.from_list(self._data, self.NUM_COLUMNS)
+
+    def iter_annotation_stores(self):
+        """Yield the annotations as AnnotationStore chunks. Only a stream is split into multiple chunks."""
+        if isinstance(self._data, AnnotationStream):
+            yield from self._data.iter_chunks()
+        else:
+            yield self.get_annotation_store()
+
+    def map_annotation_stores(self, func, label_names=None, keep_length=False, on_end=None):
+        """Return a new dataset whose annotations are func(store) for each AnnotationStore chunk.
+
+        If the dataset is a stream, func is applied lazily chunk by chunk, and on_end is called after each complete
+        iteration. Otherwise func is applied to the whole store, and on_end is called right after it.
+        """
+        if isinstance(self._data, AnnotationStream):
+            data = self._data.map_chunks(func, keep_length, on_end)
+        else:
+            data = func(self.get_annotation_store())
+            if on_end:
+                on_end()
+        return type(self)(data, self._directory, label_names=label_names, images_directory=self._images_directory)
+
+    def get_class_ids(self):
+        """Get a 1-D array of all class ids in the annotations."""
+        return self.get_annotation_store().get_columns(self.CLASS_COLUMNS).ravel()
+
     def get_num_classes(self):
-        raise NotImplementedError
+        return len(np.unique(self.get_class_ids()))
 
     def get_max_class_id(self):
-        raise NotImplementedError
+        # Computed chunk by chunk so that a stream is not loaded at once.
+        max_class_id = 0
+        for store in self.iter_annotation_stores():
+            class_ids = store.get_columns(self.CLASS_COLUMNS)
+            if class_ids.size:
+                max_class_id = max(max_class_id, int(class_ids.max()))
+        return max_class_id
+
+    @property
+    def is_stream(self):
+        return isinstance(self._data, AnnotationStream)
 
     @property
     def base_directory(self):
@@ -96,10 +241,80 @@ class ImageDataset:
         return self._label_names
 
 
+class LazyAnnotations:
+    """Read-only list of (image, labels) that parses a label entry only when it is accessed.
+
+    Only the main txt is parsed up front. Decoded labels are kept in a bounded LRU cache.
+    """
+    def __init__(self, images, label_fields, label_loader, cache_size=1024):
+        assert len(images) == len(label_fields)
+        self._images = images
+        self._label_fields = label_fields
+        self._label_loader = label_loader
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    @classmethod
+    def load(cls, main_txt, label_loader, cache_size=1024):
+        images = []
+        label_fields = []
+        for line in main_txt.splitlines():
+            fields = line.strip().split(maxsplit=1)
+            images.append(fields[0])
+            label_fields.append(fields[1] if len(fields) > 1 else None)
+        return cls(images, label_fields, label_loader, cache_size)
+
+    def __len__(self):
+        return len(self._images)
+
+    def __iter__(self):
+        # Iterating over the whole dataset doesn't populate the cache so that it stays useful for random access.
+        for i in range(len(self)):
+            cached = self._cache.get(i)
+            yield cached if cached is not None else self._load(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index out of range: {index}")
+
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        d = self._load(index)
+        self._cache[index] = d
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return d
+
+    def _load(self, index):
+        label_field = self._label_fields[index]
+        try:
+            labels = self._label_loader.load(label_field) if label_field is not None else []
+        except Exception:
+            print(f"Failed to parse '{self._images[index]} {label_field}'")
+            raise
+        return (self._images[index], labels)
+
+
 class LabelLoader:
     def __init__(self, directory):
         self._directory = directory
         self._reader = FileReader(self._directory)
+        self._packed_label_files = {}
+
+    def load_packed(self, label_field):
+        """Load labels in <npz_filepath>#<index> format as a numpy array. Each npz file is read only once."""
+        filepath, index = PackedLabelFile.parse_label_field(label_field)
+        packed_label_file = self._packed_label_files.get(filepath)
+        if packed_label_file is None:
+            packed_label_file = self._packed_label_files[filepath] = PackedLabelFile(self._directory / filepath)
+        return packed_label_file[index]
 
 
 class ImageClassificationLabelLoader(LabelLoader):
@@ -111,6 +326,9 @@ class ImageClassificationLabelLoader(LabelLoader):
 
 class ObjectDetectionLabelLoader(LabelLoader):
     def load(self, filepath):
+        if PackedLabelFile.is_packed_label(filepath):
+            return [tuple(label) for label in self.load_packed(filepath).tolist()]
+
         data = []
         for line in self._reader.read(filepath).splitlines():
             label_id, x_min, y_min, x_max, y_max = [int(s) for s in line.strip().split()]
@@ -123,6 +341,9 @@ class ObjectDetectionLabelLoader(LabelLoader):
 
 class VisualRelationshipLabelLoader(LabelLoader):
     def load(self, filepath):
+        if PackedLabelFile.is_packed_label(filepath):
+            return [tuple(label) for label in self.load_packed(filepath).tolist()]
+
         data = []
         for line in self._reader.read(filepath).splitlines():
             d = tuple(int(s) for s in line.strip().split())
@@ -134,91 +355,84 @@ class VisualRelationshipLabelLoader(LabelLoader):
 
 class ImageClassificationDataset(ImageDataset):
     LABEL_LOADER_CLASS = ImageClassificationLabelLoader
+    CLASS_COLUMNS = [0]
 
     @property
     def type(self):
         return 'image_classification'
 
-    def get_num_classes(self):
-        classes_set = set()
-        for image, labels in self:
-            classes_set.update(labels)
-        return len(classes_set)
-
-    def get_max_class_id(self):
-        max_id = 0
-        for image, labels in self:
-            if labels and max(labels) > max_id:
-                max_id = max(labels)
-        return max_id
-
 
 class ObjectDetectionDataset(ImageDataset):
     LABEL_LOADER_CLASS = ObjectDetectionLabelLoader
+    NUM_COLUMNS = 5
+    CLASS_COLUMNS = [0]
 
     @property
     def type(self):
         return 'object_detection'
 
-    def get_num_classes(self):
-        classes_set = set()
-        for image, labels in self:
-            classes_set.update(s[0] for s in labels)
-        return len(classes_set)
-
-    def get_max_class_id(self):
-        max_id = 0
-        for image, labels in self:
-            if labels:
-                m = max(s[0] for s in labels)
-                max_id = max(m, max_id)
-        return max_id
-
 
 class VisualRelationshipDataset(ImageDataset):
     LABEL_LOADER_CLASS = VisualRelationshipLabelLoader
+    NUM_COLUMNS = 11
+    CLASS_COLUMNS = [0, 5, 10]
 
     @property
     def type(self):
         return 'visual_relationship'
 
-    def get_num_classes(self):
-        classes_set = set()
-        for image, labels in self:
-            classes_set.update(s[0] for s in labels)
-            classes_set.update(s[5] for s in labels)
-            classes_set.update(s[10] for s in labels)
-        return len(classes_set)
-
-    def get_max_class_id(self):
-        max_id = 0
-        for image, labels in self:
-            if labels:
-                max_id = max(max(s[0] for s in labels), max_id)
-                max_id = max(max(s[5] for s in labels), max_id)
-                max_id = max(max(s[10] for s in labels), max_id)
-        return max_id
-
 
 class SimpleDatasetFactory:
     SUPPORTED_DATASET = {'image_classification': ImageClassificationDataset,
                          'object_detection': ObjectDetectionDataset,
                          'visual_relationship': VisualRelationshipDataset}
 
-    def load(self, main_txt_or_filepath, directory=None, images_directory=None, dataset_type=None):
+    def load(self, main_txt_or_filepath, directory=None, images_directory=None, dataset_type=None, lazy=False, use_cache=False, stream=False):
+        """Load a dataset.
+
+        If lazy is True, label entries are parsed on first access instead of at load time.
+        If stream is True, the main txt and the label entries are read chunk by chunk each time the dataset is iterated,
+        so the memory usage doesn't depend on the dataset size. A stream doesn't support random access. If use_cache is
+        also True, the stream is read from a valid cache file instead, or the cache is written while the stream is
+        iterated for the first time.
+        If use_cache is True, the parsed dataset is saved to a binary cache file next to the main txt and reused by the
+        next load as long as the main txt and the label files are not modified. Without a valid cache, a lazy dataset is
+        fully parsed to create it.
+        """
+        cache = None
         if isinstance(main_txt_or_filepath, pathlib.Path):
-            main_txt = main_txt_or_filepath.read_text()
+            if use_cache and directory in (None, main_txt_or_filepath.parent):
+                cache = DatasetCache(main_txt_or_filepath)
             directory = directory or main_txt_or_filepath.parent
         else:
-            main_txt = main_txt_or_filepath
             directory = directory or pathlib.Path.cwd()
 
+        if cache:
+            cached = cache.load(stream=stream)
+            if cached and cached[0] == (dataset_type or cached[0]):
+                logger.info(f"Loaded the dataset from {cache.filepath}")
+                return self.SUPPORTED_DATASET[cached[0]](cached[1], directory, images_directory=images_directory)
+
+        if stream:
+            assert isinstance(main_txt_or_filepath, pathlib.Path)
+            if not dataset_type:
+                with open(main_txt_or_filepath) as f:
+                    dataset_type = DatasetTypeDetector().detect_lines(f, directory)
+            create_cache_writer = (lambda: cache.create_writer(dataset_type)) if cache else None
+            return self.SUPPORTED_DATASET[dataset_type].load_stream(main_txt_or_filepath, directory, images_directory, create_cache_writer=create_cache_writer)
+
+        main_txt = main_txt_or_filepath.read_text() if isinstance(main_txt_or_filepath, pathlib.Path) else main_txt_or_filepath
+
         dataset_type = dataset_type or DatasetTypeDetector().detect(main_txt, directory)
         if dataset_type not in self.SUPPORTED_DATASET:
             raise RuntimeError(f"Unsupported dataset type: {dataset_type}")
 
         dataset_class = self.SUPPORTED_DATASET[dataset_type]
-        return dataset_class.load(main_txt, directory, images_directory)
+        # The cache needs all the label entries, so they are parsed now even if lazy is True.
+        dataset = dataset_class.load(main_txt, directory, images_directory, lazy=lazy and not cache)
+        if cache:
+            cache.save(dataset_type, dataset.get_annotation_store(), main_txt)
+        return dataset
 
     def create(self, dataset_type, data, directory, label_names=None, images_directory=None):
         dataset_class = self.SUPPORTED_DATASET[dataset_type]
@@ -0,0 +1,240 @@
+import itertools
+import logging
+import os
+import re
+import struct
+import tempfile
+import zipfile
+import numpy as np
+from .annotation_store import AnnotationStore
+from .annotation_stream import AnnotationStream
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetCache:
+    """Binary cache of a parsed dataset. It is saved as <main_txt>.cache.npz next to the main txt file.
+
+    The cache keeps the dataset type, the image paths and the packed annotations. It is invalidated when the size or
+    the modification time of the main txt or of any referenced label file is changed.
+    """
+    VERSION = 1
+
+    def __init__(self, main_txt_filepath):
+        self._directory = main_txt_filepath.parent
+        self._main_txt_filename = main_txt_filepath.name
+        self._cache_filepath = main_txt_filepath.with_name(main_txt_filepath.name + '.cache.npz')
+
+    @property
+    def filepath(self):
+        return self._cache_filepath
+
+    def load(self, stream=False, chunk_size=10000):
+        """Returns (dataset_type, AnnotationStore) if there is a valid cache. Otherwise returns None.
+
+        If stream is True, an AnnotationStream is returned instead. Its chunks of chunk_size images are read from the
+        memory-mapped cache file on each iteration, so the cache is not loaded at once.
+        """
+        if not self._cache_filepath.exists():
+            return None
+
+        try:
+            with np.load(self._cache_filepath, allow_pickle=False) as data:
+                if int(data['version']) != self.VERSION:
+                    return None
+                if not np.array_equal(self._get_stats(data['dependencies'].tolist()), data['stats']):
+                    logger.info(f"{self._cache_filepath} is outdated.")
+                    return None
+                if stream:
+                    images, offsets, annotations = (self._memmap_array(name) for name in ('images', 'offsets', 'annotations'))
+                    return str(data['dataset_type']), self._make_stream(images, offsets, annotations, chunk_size)
+                store = AnnotationStore(data['images'].tolist(), data['offsets'], data['annotations'])
+                return str(data['dataset_type']), store
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning(f"Failed to load {self._cache_filepath}: {e}")
+            return None
+
+    def save(self, dataset_type, store, main_txt=None):
+        """Save the store. If main_txt is None, the label files are listed by reading the main txt file line by line."""
+        dependencies = self._get_dependencies(dataset_type, main_txt)
+        tmp_filepath = self._cache_filepath.with_name(self._cache_filepath.name + '.tmp')
+        try:
+            with open(tmp_filepath, 'wb') as f:
+                np.savez(f, version=self.VERSION, dataset_type=dataset_type, images=np.array(store.images, dtype=str),
+                         offsets=store.offsets, annotations=store.annotations,
+                         dependencies=np.array(dependencies, dtype=str), stats=self._get_stats(dependencies))
+            os.replace(tmp_filepath, self._cache_filepath)
+        except OSError as e:
+            logger.warning(f"Failed to save {self._cache_filepath}: {e}")
+
+    def _memmap_array(self, name):
+        """Map an array in the cache file. The file is written without compression, so the data is in the file as it is."""
+        with zipfile.ZipFile(self._cache_filepath) as zip_f:
+            info = zip_f.getinfo(name + '.npy')
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{name} is compressed.")
+            with zip_f.open(info) as f:
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(f)
+                header_size = f.tell()
+
+        if fortran_order:
+            raise ValueError(f"{name} is not in C order.")
+        if 0 in shape:
+            return np.empty(shape, dtype=dtype)
+        with open(self._cache_filepath, 'rb') as f:
+            f.seek(info.header_offset)
+            local_header = f.read(zipfile.sizeFileHeader)
+        filename_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        offset = info.header_offset + zipfile.sizeFileHeader + filename_length + extra_length + header_size
+        return np.memmap(self._cache_filepath, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    @staticmethod
+    def _make_stream(images, offsets, annotations, chunk_size):
+        def read_chunks():
+            for start in range(0, max(len(images), 1), chunk_size):
+                end = min(start + chunk_size, len(images))
+                chunk_offsets = np.array(offsets[start:end + 1])
+                yield AnnotationStore(images[start:end].tolist(), chunk_offsets - chunk_offsets[0], np.array(annotations[chunk_offsets[0]:chunk_offsets[-1]]))
+
+        return AnnotationStream(read_chunks, len(images))
+
+    def create_writer(self, dataset_type):
+        """Returns a DatasetCacheWriter to save the cache from AnnotationStore chunks without keeping them in memory."""
+        return DatasetCacheWriter(self, dataset_type)
+
+    def _get_dependencies(self, dataset_type, main_txt=None):
+        if main_txt is None:
+            with open(self._directory / self._main_txt_filename) as f:
+                label_files = self._find_label_files(dataset_type, f)
+        else:
+            label_files = self._find_label_files(dataset_type, main_txt.splitlines())
+        return [self._main_txt_filename] + sorted(label_files)
+
+    def _get_stats(self, filenames):
+        stats = np.zeros((len(filenames), 2), dtype=np.int64)
+        for i, filename in enumerate(filenames):
+            try:
+                s = os.stat(self._directory / filename)
+                stats[i] = (s.st_size, s.st_mtime_ns)
+            except OSError:
+                stats[i] = (-1, -1)
+        return stats
+
+    @staticmethod
+    def _find_label_files(dataset_type, lines):
+        if dataset_type == 'image_classification':
+            return set()
+
+        label_files = set()
+        for line in lines:
+            fields = line.strip().split(maxsplit=1)
+            if len(fields) > 1:
+                label_files.add(re.split('[@#]', fields[1])[0])
+        return label_files
+
+
+class DatasetCacheWriter:
+    """Save a DatasetCache from AnnotationStore chunks.
+
+    The image paths, the offsets and the annotations of each chunk are appended to temporary files, and they are
+    copied into the cache file by close(). Only a chunk is kept in memory. A failure to write the cache is logged, and
+    the cache is not saved.
+    """
+    _IMAGES_PER_BLOCK = 10000
+
+    def __init__(self, cache, dataset_type):
+        self._cache = cache
+        self._dataset_type = dataset_type
+        self._num_images = 0
+        self._num_annotations = 0
+        self._max_image_length = 1
+        self._annotations_dtype = None
+        self._annotations_shape = None  # The shape of an annotation. () for Image Classification.
+        self._images_f = self._offsets_f = self._annotations_f = None
+        try:
+            self._images_f = tempfile.TemporaryFile('w+', encoding='utf-8', dir=cache.filepath.parent)
+            self._offsets_f = tempfile.TemporaryFile(dir=cache.filepath.parent)
+            self._annotations_f = tempfile.TemporaryFile(dir=cache.filepath.parent)
+        except OSError as e:
+            self._fail(e)
+
+    def add(self, store):
+        if self._images_f is None:
+            return
+        try:
+            for image in store.images:
+                self._images_f.write(image + '\n')
+                self._max_image_length = max(self._max_image_length, len(image))
+            offsets = store.offsets[1:] - store.offsets[0] + self._num_annotations
+            self._offsets_f.write(offsets.astype(np.int64).tobytes())
+            self._annotations_f.write(np.ascontiguousarray(store.annotations).tobytes())
+        except OSError as e:
+            self._fail(e)
+            return
+
+        self._num_images += len(store)
+        self._num_annotations += len(store.annotations)
+        self._annotations_dtype = store.annotations.dtype
+        self._annotations_shape = store.annotations.shape[1:]
+
+    def close(self):
+        """Write the cache file and remove the temporary files."""
+        if self._images_f is None or self._annotations_dtype is None:
+            self.abort()
+            return
+
+        cache_filepath = self._cache.filepath
+        tmp_filepath = cache_filepath.with_name(cache_filepath.name + '.tmp')
+        try:
+            dependencies = self._cache._get_dependencies(self._dataset_type)
+            with zipfile.ZipFile(tmp_filepath, 'w', allowZip64=True) as zip_f:
+                self._write_array(zip_f, 'version', np.array(DatasetCache.VERSION))
+                self._write_array(zip_f, 'dataset_type', np.array(self._dataset_type))
+                with self._open_array(zip_f, 'images', np.dtype(f'<U{self._max_image_length}'), (self._num_images,)) as f:
+                    self._images_f.seek(0)
+                    for lines in iter(lambda: list(itertools.islice(self._images_f, self._IMAGES_PER_BLOCK)), []):
+                        f.write(np.array([line[:-1] for line in lines], dtype=f'<U{self._max_image_length}').tobytes())
+                with self._open_array(zip_f, 'offsets', np.dtype(np.int64), (self._num_images + 1,)) as f:
+                    f.write(np.zeros(1, dtype=np.int64).tobytes())
+                    self._copy_file(self._offsets_f, f)
+                with self._open_array(zip_f, 'annotations', self._annotations_dtype, (self._num_annotations, *self._annotations_shape)) as f:
+                    self._copy_file(self._annotations_f, f)
+                self._write_array(zip_f, 'dependencies', np.array(dependencies, dtype=str))
+                self._write_array(zip_f, 'stats', self._cache._get_stats(dependencies))
+            os.replace(tmp_filepath, cache_filepath)
+        except OSError as e:
+            tmp_filepath.unlink(missing_ok=True)
+            logger.warning(f"Failed to save {cache_filepath}: {e}")
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Remove the temporary files without saving the cache."""
+        for f in (self._images_f, self._offsets_f, self._annotations_f):
+            if f:
+                f.close()
+        self._images_f = self._offsets_f = self._annotations_f = None
+
+    def _fail(self, error):
+        logger.warning(f"Failed to save {self._cache.filepath}: {error}")
+        self.abort()
+
+    @staticmethod
+    def _write_array(zip_f, name, array):
+        with zip_f.open(name + '.npy', 'w') as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    @staticmethod
+    def _open_array(zip_f, name, dtype, shape):
+        """Open an .npy file in the zip file, and write its header. The data is written by the caller."""
+        f = zip_f.open(name + '.npy', 'w', force_zip64=True)
+        np.lib.format.write_array_header_2_0(f, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+        return f
+
+    @staticmethod
+    def _copy_file(src_f, dst_f, chunk_size=1024 * 1024):
+        src_f.seek(0)
+        for chunk in iter(lambda: src_f.read(chunk_size), b''):
+            dst_f.write(chunk)
@@ -1,10 +1,15 @@
 import re
 from .file_reader import FileReader
+from .packed_label_file import PackedLabelFile
 
 
 class DatasetTypeDetector:
     def detect(self, main_txt, directory):
-        for line in main_txt.splitlines():
+        return self.detect_lines(main_txt.splitlines(), directory)
+
+    def detect_lines(self, lines, directory):
+        """Detect the type from an iterable of main txt lines. Lines are read only until a labeled line is found."""
+        for line in lines:
             fields = line.strip().split()
             if len(fields) == 1:
                 continue
@@ -13,6 +18,14 @@ class DatasetTypeDetector:
             if re.match(r'[0-9,]+', label_field):
                 return 'image_classification'
 
+            if PackedLabelFile.is_packed_label(label_field):
+                num_columns = PackedLabelFile.read_num_columns(directory / PackedLabelFile.parse_label_field(label_field)[0])
+                if num_columns == 5:
+                    return 'object_detection'
+                if num_columns == 11:
+                    return 'visual_relationship'
+                raise RuntimeError("Failed to detect the dataset type.")
+
             reader = FileReader(directory)
             label_file_contents = reader.read(label_field)
 
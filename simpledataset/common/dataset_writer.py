@@ -1,6 +1,18 @@
+import contextlib
+import itertools
 import logging
+import os
+import pathlib
+import shutil
+import time
 import zipfile
+import zlib
 import tqdm
+from .annotation_store import AnnotationStoreBuilder
+from .dataset_type_detector import DatasetTypeDetector
+from .packed_label_file import PackedLabelFile
+from .parallel import imap_ordered
+from .zip_utils import write_raw_entry
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +29,54 @@ def _make_unique_filepath(filepath):
     raise RuntimeError(f"Failed to find a unique filename for {filepath}")
 
 
+def _chunked(iterable, chunk_size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+def _get_length(dataset):
+    """Returns len(dataset), or None if the dataset is a stream with unknown length."""
+    try:
+        return len(dataset)
+    except TypeError:
+        return None
+
+
+def _link_file(src_filepath, dst_filepath):
+    """Hardlink src_filepath to dst_filepath. If it is not possible, e.g. across file systems, try a reflink.
+
+    Returns False if neither is possible.
+    """
+    try:
+        os.link(src_filepath, dst_filepath)
+        return True
+    except OSError:
+        pass
+
+    try:
+        _reflink_file(src_filepath, dst_filepath)
+        return True
+    except (ImportError, OSError):
+        if dst_filepath.exists():
+            dst_filepath.unlink()
+    return False
+
+
+def _reflink_file(src_filepath, dst_filepath):
+    import fcntl  # Not available on Windows.
+    FICLONE = 0x40049409  # Linux ioctl to share the data blocks on btrfs, XFS and so on.
+    with open(src_filepath, 'rb') as src_f, open(dst_filepath, 'xb') as dst_f:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
 class LabelWriter:
-    def __init__(self, directory):
+    def __init__(self, directory, num_workers=1, append=False):
         self._directory = directory
+        self._num_workers = num_workers
+        self._append = append
 
 
 class ImageClassificationLabelWriter(LabelWriter):
@@ -30,66 +87,341 @@ class ImageClassificationLabelWriter(LabelWriter):
 
 
 class ZipLabelWriter(LabelWriter):
+    """Write a label file per image into labels.zip.
+
+    Label files are formatted and compressed in chunks on worker processes, then the compressed data is written into
+    the zip file as it is. In append mode, new label files are added to the existing labels.zip.
+    """
+    CHUNK_SIZE = 1000
+
     def write(self, file_handler, dataset):
-        label_zip_filepath = _make_unique_filepath(self._directory / 'labels.zip')
+        label_zip_filepath = self._directory / 'labels.zip'
+        append = self._append and label_zip_filepath.exists()
+        if not append:
+            label_zip_filepath = _make_unique_filepath(label_zip_filepath)
         label_zip_filename = label_zip_filepath.name
-        # Use zlib to compress the labels.zip. It's fastest and have good compression ratio.
-        with zipfile.ZipFile(label_zip_filepath, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_f:
-            for i, (image, labels) in enumerate(dataset):
-                with zip_f.open(f'{i}.txt', 'w') as zf:
-                    self.write_label(zf, labels)
-                file_handler.write(f'{image} {label_zip_filename}@{i}.txt\n')
+        compressed_chunks = imap_ordered(self._compress_labels, _chunked(dataset, self.CHUNK_SIZE), self._num_workers, use_processes=True)
+        date_time = time.localtime(time.time())[:6]
+
+        with zipfile.ZipFile(label_zip_filepath, mode='a' if append else 'w', compression=zipfile.ZIP_DEFLATED) as zip_f:
+            existing_names = set(zip_f.namelist())
+            i = len(existing_names)
+            for compressed_chunk in compressed_chunks:
+                for image, crc, file_size, compressed in compressed_chunk:
+                    while f'{i}.txt' in existing_names:
+                        i += 1
+                    info = zipfile.ZipInfo(f'{i}.txt', date_time=date_time)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info.CRC = crc
+                    info.file_size = file_size
+                    info.compress_size = len(compressed)
+                    write_raw_entry(zip_f, info.filename, info, compressed)
+                    file_handler.write(f'{image} {label_zip_filename}@{i}.txt\n')
+                    i += 1
+
+    def _compress_labels(self, chunk):
+        """Returns (image, CRC-32, size, compressed data) of the label file of each image."""
+        results = []
+        for image, labels in chunk:
+            data = self.format_label(labels).encode('utf-8')
+            # Use zlib to compress the labels.zip. It's fastest and have good compression ratio. The same parameters as zipfile are used.
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            results.append((image, zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()))
+        return results
 
 
 class ObjectDetectionLabelWriter(ZipLabelWriter):
-    def write_label(self, file_handler, labels):
-        for label_id, x, y, x2, y2 in labels:
-            file_handler.write(f'{label_id} {x} {y} {x2} {y2}\n'.encode('utf-8'))
+    def format_label(self, labels):
+        return ''.join(f'{label_id} {x} {y} {x2} {y2}\n' for label_id, x, y, x2, y2 in labels)
 
 
 class VisualRelationshipLabelWriter(ZipLabelWriter):
-    def write_label(self, file_handler, labels):
-        for subject_id, sx, sy, sx2, sy2, object_id, ox, oy, ox2, oy2, predicate_id in labels:
-            file_handler.write(f'{subject_id} {sx} {sy} {sx2} {sy2} {object_id} {ox} {oy} {ox2} {oy2} {predicate_id}\n'.encode('utf-8'))
+    def format_label(self, labels):
+        return ''.join(f'{subject_id} {sx} {sy} {sx2} {sy2} {object_id} {ox} {oy} {ox2} {oy2} {predicate_id}\n'
+                       for subject_id, sx, sy, sx2, sy2, object_id, ox, oy, ox2, oy2, predicate_id in labels)
+
+
+class PackedLabelWriter(LabelWriter):
+    """Write the labels of all images into a single labels.npz. See PackedLabelFile for the format."""
+    NUM_COLUMNS = None
+
+    def write(self, file_handler, dataset):
+        label_filepath = _make_unique_filepath(self._directory / 'labels.npz')
+        builder = AnnotationStoreBuilder(self.NUM_COLUMNS)
+        for i, (image, labels) in enumerate(dataset):
+            builder.append(image, labels)
+            file_handler.write(f'{image} {label_filepath.name}{PackedLabelFile.SEPARATOR}{i}\n')
+        store = builder.build()
+        PackedLabelFile.save(label_filepath, store.offsets, store.annotations)
+
+
+class ObjectDetectionPackedLabelWriter(PackedLabelWriter):
+    NUM_COLUMNS = 5
+
+
+class VisualRelationshipPackedLabelWriter(PackedLabelWriter):
+    NUM_COLUMNS = 11
+
+
+class ImageZipWriter:
+    """Write images into images.zip. If a shard limit is given, images are split into images_00000.zip, images_00001.zip, ...
+
+    Args:
+        directory (pathlib.Path): The output directory.
+        max_images_per_zip (int): The max number of images in a shard.
+        max_zip_size (int): The max total size of images in a shard in bytes. A shard has at least one image.
+        append (bool): Add images to the existing images.zip. If sharded, new shards are added after the existing ones.
+        rename_duplicated_entries (bool): Rename an entry if the name is already used in the zip file. Always enabled
+            in append mode.
+    """
+    def __init__(self, directory, max_images_per_zip=None, max_zip_size=None, append=False, rename_duplicated_entries=False):
+        self._directory = directory
+        self._max_images_per_zip = max_images_per_zip
+        self._max_zip_size = max_zip_size
+        self._append = append
+        self._rename_duplicated_entries = append or rename_duplicated_entries
+        self._entry_names = None  # The entry names in the current zip file. Tracked only if entries are renamed.
+        self._zip_f = None
+        self._zip_filename = None
+        self._num_shards = 0
+        self._num_images = 0
+        self._size = 0
+
+    def __enter__(self):
+        self._open_next_zip()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, entry_name, image_binary):
+        """Add an image and returns its path in <zip_filename>@<entry_name> format."""
+        if self._is_shard_full(len(image_binary)):
+            self._open_next_zip()
+
+        entry_name = self._make_unique_entry_name(entry_name)
+        with self._zip_f.open(entry_name, 'w') as zf:
+            zf.write(image_binary)
+        self._num_images += 1
+        self._size += len(image_binary)
+        return f'{self._zip_filename}@{entry_name}'
+
+    def write_raw(self, entry_name, source_info, raw_data):
+        """Add an image by copying the data of a zip entry as it is. Returns its path.
+
+        Only a stored entry is copied as it is. A compressed entry is decompressed and stored, so that all the images
+        in images.zip are stored and can be read without decompression.
+        """
+        if source_info.compress_type != zipfile.ZIP_STORED:
+            return self.write(entry_name, zlib.decompress(raw_data, -zlib.MAX_WBITS))
+
+        if self._is_shard_full(source_info.file_size):
+            self._open_next_zip()
+
+        entry_name = self._make_unique_entry_name(entry_name)
+        write_raw_entry(self._zip_f, entry_name, source_info, raw_data)
+        self._num_images += 1
+        self._size += source_info.file_size
+        return f'{self._zip_filename}@{entry_name}'
+
+    def close(self):
+        if self._zip_f:
+            self._zip_f.close()
+            self._zip_f = None
+
+    @property
+    def is_sharded(self):
+        return bool(self._max_images_per_zip or self._max_zip_size)
+
+    def _is_shard_full(self, image_size):
+        if not self.is_sharded or self._num_images == 0:
+            return False
+        if self._max_images_per_zip and self._num_images >= self._max_images_per_zip:
+            return True
+        return bool(self._max_zip_size and self._size + image_size > self._max_zip_size)
+
+    def _make_unique_entry_name(self, entry_name):
+        if self._entry_names is None:
+            return entry_name
+
+        stem, dot, suffix = entry_name.rpartition('.')
+        new_entry_name = entry_name
+        i = 0
+        while new_entry_name in self._entry_names:
+            new_entry_name = f'{stem}_{i}.{suffix}' if dot else f'{entry_name}_{i}'
+            i += 1
+        self._entry_names.add(new_entry_name)
+        return new_entry_name
+
+    def _open_next_zip(self):
+        self.close()
+        mode = 'w'
+        if self.is_sharded:
+            if self._append:
+                while (self._directory / f'images_{self._num_shards:05d}.zip').exists():
+                    self._num_shards += 1
+            zip_filepath = _make_unique_filepath(self._directory / f'images_{self._num_shards:05d}.zip')
+        elif self._append and (self._directory / 'images.zip').exists():
+            zip_filepath = self._directory / 'images.zip'
+            mode = 'a'
+        else:
+            zip_filepath = _make_unique_filepath(self._directory / 'images.zip')
+
+        logger.info(f"Saving images to {zip_filepath}")
+        self._zip_f = zipfile.ZipFile(zip_filepath, mode=mode, compression=zipfile.ZIP_STORED)
+        self._zip_filename = zip_filepath.name
+        self._entry_names = set(self._zip_f.namelist()) if self._rename_duplicated_entries else None
+        self._num_shards += 1
+        self._num_images = 0
+        self._size = 0
 
 
 class DatasetWriter:
     LABEL_WRITERS = {'image_classification': ImageClassificationLabelWriter,
                      'object_detection': ObjectDetectionLabelWriter,
                      'visual_relationship': VisualRelationshipLabelWriter}
+    PACKED_LABEL_WRITERS = {'object_detection': ObjectDetectionPackedLabelWriter,
+                            'visual_relationship': VisualRelationshipPackedLabelWriter}
 
-    def write(self, dataset, output_filepath, skip_labels_txt=False, copy_images=False):
+    def write(self, dataset, output_filepath, skip_labels_txt=False, copy_images=False, num_workers=1, max_images_per_zip=None, max_zip_size=None,
+              image_mode='copy', packed_labels=False, append=False):
+        """Save the dataset to output_filepath.
+
+        Args:
+            copy_images (bool): Put the images in the output directory in the way specified by image_mode.
+            num_workers (int): The number of threads to read images while copying them, and the number of processes to compress label files.
+            max_images_per_zip (int): Split the copied images into images_NNNNN.zip with at most this number of images.
+            max_zip_size (int): Split the copied images into images_NNNNN.zip with at most this size in bytes.
+            image_mode (str): 'copy' copies the images into a new images.zip. 'link' hardlinks or reflinks the source
+                zip files and image files into the output directory. 'reference' keeps the images where they are and
+                writes their paths relative to the output directory.
+            packed_labels (bool): Save Object Detection and Visual Relationship labels into a single labels.npz
+                instead of a file per image in labels.zip. Image Classification labels are always in the main txt.
+            append (bool): Add the dataset to the existing dataset at output_filepath. Lines are appended to the main
+                txt, and images and label files are added to the existing images.zip and labels.zip, so the existing
+                content is not rewritten. The class names must extend or match the existing labels.txt.
+        """
+        assert image_mode in ('copy', 'link', 'reference')
         output_filepath.parent.mkdir(parents=True, exist_ok=True)
+        append = append and output_filepath.exists()
+        if append:
+            self._check_dataset_type(dataset.type, output_filepath)
 
         # Generate labels.txt
         if not skip_labels_txt:
-            self._write_labels_file(dataset.labels, output_filepath.parent / 'labels.txt')
-
-        data = [(image, labels) for image, labels in dataset]
-
-        if copy_images:
-            new_data = []
-            images_zip_filepath = _make_unique_filepath(output_filepath.parent / 'images.zip')
-            images_zip_filename = images_zip_filepath.name
-            logger.info(f"Saving images to {images_zip_filepath}")
-
-            has_duplicated_entry_name = self._has_duplicated_entry_name(dataset)
-
-            with zipfile.ZipFile(images_zip_filepath, mode='w', compression=zipfile.ZIP_STORED) as f:
-                for i, (image, labels) in enumerate(tqdm.tqdm(data, "Copying images.", disable=None)):
-                    entry_name = image.split('@')[-1]
-                    if has_duplicated_entry_name:
-                        suffix = entry_name.split('.')[-1]
-                        entry_name = f'{i}.{suffix}'
-                    image_binary = dataset.read_image_binary(image)
-                    with f.open(entry_name, 'w') as zf:
-                        zf.write(image_binary)
-                    new_data.append((f'{images_zip_filename}@{entry_name}', labels))
-            data = new_data
-
-        label_writer = self.LABEL_WRITERS[dataset.type](output_filepath.parent)
-        with open(output_filepath, 'w') as f:
-            label_writer.write(f, data)
+            if append:
+                self._append_labels_file(dataset.labels, output_filepath.parent / 'labels.txt')
+            else:
+                self._write_labels_file(dataset.labels, output_filepath.parent / 'labels.txt')
+
+        # The dataset is consumed lazily so that a stream is never loaded at once.
+        data = iter(dataset)
+
+        if copy_images and image_mode == 'copy':
+            data = self._copy_images(dataset, data, output_filepath.parent, num_workers, max_images_per_zip, max_zip_size, append)
+        elif copy_images and image_mode == 'link':
+            data = self._link_images(dataset, data, output_filepath.parent)
+        elif copy_images and image_mode == 'reference':
+            data = self._reference_images(dataset, data, output_filepath.parent)
+
+        label_writer_class = self.PACKED_LABEL_WRITERS.get(dataset.type) if packed_labels else None
+        label_writer = (label_writer_class or self.LABEL_WRITERS[dataset.type])(output_filepath.parent, num_workers, append)
+        if append:
+            self._append_main_txt(output_filepath, label_writer, data)
+        else:
+            # Written to a temporary file first so that a failure doesn't leave an incomplete dataset.
+            tmp_filepath = output_filepath.with_name(output_filepath.name + '.tmp')
+            try:
+                with open(tmp_filepath, 'w') as f:
+                    label_writer.write(f, data)
+                os.replace(tmp_filepath, output_filepath)
+            finally:
+                tmp_filepath.unlink(missing_ok=True)
+
+    def _append_main_txt(self, output_filepath, label_writer, data):
+        """Append the lines to the main txt. The main txt is truncated back to the original length on failure."""
+        original_size = output_filepath.stat().st_size
+        try:
+            with open(output_filepath, 'a') as f:
+                if not self._ends_with_newline(output_filepath):
+                    f.write('\n')
+                label_writer.write(f, data)
+        except BaseException:
+            os.truncate(output_filepath, original_size)
+            raise
+
+    def _copy_images(self, dataset, data, directory, num_workers, max_images_per_zip, max_zip_size, append=False):
+        """Yield (new image path, labels) while copying the images."""
+        # A stream is not scanned in advance. A duplicated entry name is renamed when it's written.
+        has_duplicated_entry_name = not dataset.is_stream and self._has_duplicated_entry_name(dataset)
+
+        # Reading images is the bottleneck on network storage. Prefetch them in parallel and write them in order.
+        # A stored image in a zip file is copied with its data and CRC as they are.
+        data, images = itertools.tee(data)
+        images = imap_ordered(lambda image: dataset.read_image_raw(image) or (None, dataset.read_image_binary(image)), (image for image, _ in images), num_workers)
+        with ImageZipWriter(directory, max_images_per_zip, max_zip_size, append, rename_duplicated_entries=dataset.is_stream) as zip_writer:
+            for i, ((image, labels), (zip_info, image_binary)) in enumerate(tqdm.tqdm(zip(data, images), "Copying images.", total=_get_length(dataset), disable=None)):
+                entry_name = image.split('@')[-1]
+                if has_duplicated_entry_name:
+                    suffix = entry_name.split('.')[-1]
+                    entry_name = f'{i}.{suffix}'
+                if zip_info:
+                    yield zip_writer.write_raw(entry_name, zip_info, image_binary), labels
+                else:
+                    yield zip_writer.write(entry_name, image_binary), labels
+
+    @staticmethod
+    def _link_images(dataset, data, directory):
+        """Link the zip files and image files that are used by the dataset into the directory. Yield (new image path, labels).
+
+        If a zip file cannot be linked, e.g. across file systems, only the images used by the dataset are copied from it
+        into a new images.zip instead of copying the whole zip file.
+        """
+        new_filepaths = {}  # None if the images are copied into images.zip.
+        zip_writer = None
+        with contextlib.ExitStack() as stack:
+            for image, labels in data:
+                filepath, separator, entry_name = image.partition('@')
+                if filepath not in new_filepaths:
+                    src_filepath = dataset.base_images_directory / filepath
+                    # Keep the relative path if possible so that files with the same name don't conflict.
+                    relative_path = pathlib.PurePosixPath(filepath)
+                    if relative_path.is_absolute() or '..' in relative_path.parts:
+                        relative_path = pathlib.PurePosixPath(relative_path.name)
+                    dst_filepath = _make_unique_filepath(directory / relative_path)
+                    dst_filepath.parent.mkdir(parents=True, exist_ok=True)
+                    if _link_file(src_filepath, dst_filepath):
+                        new_filepaths[filepath] = dst_filepath.relative_to(directory).as_posix()
+                    elif separator:
+                        logger.warning(f"Failed to link {src_filepath}. Copying the images in it into images.zip.")
+                        new_filepaths[filepath] = None
+                    else:
+                        logger.warning(f"Failed to link {src_filepath}. Copying it to {dst_filepath}.")
+                        shutil.copyfile(src_filepath, dst_filepath)
+                        new_filepaths[filepath] = dst_filepath.relative_to(directory).as_posix()
+
+                if new_filepaths[filepath] is not None:
+                    yield new_filepaths[filepath] + separator + entry_name, labels
+                    continue
+
+                if zip_writer is None:
+                    zip_writer = stack.enter_context(ImageZipWriter(directory, rename_duplicated_entries=True))
+                raw = dataset.read_image_raw(image)
+                if raw:
+                    yield zip_writer.write_raw(entry_name, *raw), labels
+                else:
+                    yield zip_writer.write(entry_name, dataset.read_image_binary(image)), labels
+
+    @staticmethod
+    def _reference_images(dataset, data, directory):
+        """Rewrite the image paths so that they point to the source images from the directory. Yield (new image path, labels)."""
+        new_filepaths = {}
+        for image, labels in data:
+            filepath, separator, entry_name = image.partition('@')
+            if filepath not in new_filepaths:
+                relative_path = os.path.relpath(dataset.base_images_directory / filepath, directory)
+                new_filepaths[filepath] = pathlib.Path(relative_path).as_posix()
+            yield new_filepaths[filepath] + separator + entry_name, labels
 
     def _write_labels_file(self, label_names, labels_filepath):
         if labels_filepath.exists():
@@ -101,6 +433,33 @@ class DatasetWriter:
 
         labels_filepath.write_text('\n'.join(label_names))
 
+    def _append_labels_file(self, label_names, labels_filepath):
+        existing_labels = [x.strip() for x in labels_filepath.read_text().splitlines()] if labels_filepath.exists() else []
+        longer, shorter = (label_names, existing_labels) if len(label_names) >= len(existing_labels) else (existing_labels, label_names)
+        if longer[:len(shorter)] != shorter:
+            raise ValueError(f"The class names don't match with the existing {labels_filepath}.")
+        if longer != existing_labels:
+            labels_filepath.write_text('\n'.join(longer))
+
+    @staticmethod
+    def _check_dataset_type(dataset_type, main_txt_filepath):
+        # Only the first lines are checked so that a large main txt is not read.
+        with open(main_txt_filepath) as f:
+            main_txt = ''.join(itertools.islice(f, 1000))
+        if not any(len(line.split()) > 1 for line in main_txt.splitlines()):
+            return  # The type is unknown if there is no label.
+        existing_type = DatasetTypeDetector().detect(main_txt, main_txt_filepath.parent)
+        if existing_type != dataset_type:
+            raise ValueError(f"Cannot append {dataset_type} dataset to {existing_type} dataset {main_txt_filepath}.")
+
+    @staticmethod
+    def _ends_with_newline(filepath):
+        with open(filepath, 'rb') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
     @staticmethod
     def _has_duplicated_entry_name(dataset):
         entry_name_set = set()
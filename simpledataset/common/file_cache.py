@@ -0,0 +1,64 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FileInfoCache:
+    """Persisted cache of values computed from files, saved as a TSV file in the dataset directory.
+
+    An entry is keyed by the file path and its fingerprint, so it is not used once the file is modified. New entries are
+    appended to the file on save().
+    """
+    FILENAME = None
+    NUM_VALUE_FIELDS = 1
+
+    def __init__(self, directory):
+        self._filepath = directory / self.FILENAME
+        self._values = {}
+        self._new_entries = []
+        self._lock = threading.Lock()
+
+        if self._filepath.exists():
+            for line in self._filepath.read_text().splitlines():
+                fields = line.split('\t')
+                if len(fields) == 2 + self.NUM_VALUE_FIELDS:
+                    self._values[(fields[0], fields[1])] = self._parse_value(fields[2:])
+
+    @staticmethod
+    def get_fingerprint(file_stat):
+        """Make a fingerprint from a FileStat. The CRC is used for a zip entry, and the mtime for a normal file."""
+        return f'{file_stat.size}:{file_stat.crc if file_stat.crc is not None else file_stat.mtime_ns}'
+
+    def get(self, filepath, fingerprint):
+        return self._values.get((filepath, fingerprint))
+
+    def set(self, filepath, fingerprint, value):
+        with self._lock:
+            if (filepath, fingerprint) not in self._values:
+                self._values[(filepath, fingerprint)] = value
+                self._new_entries.append((filepath, fingerprint, value))
+
+    def save(self):
+        """Append new entries to the cache file."""
+        with self._lock:
+            if not self._new_entries:
+                return
+            try:
+                with open(self._filepath, 'a') as f:
+                    for filepath, fingerprint, value in self._new_entries:
+                        f.write(f'{filepath}\t{fingerprint}\t{self._format_value(value)}\n')
+                self._new_entries = []
+            except OSError as e:
+                logger.warning(f"Failed to save {self._filepath}: {e}")
+
+    def _parse_value(self, fields):
+        return fields[0]
+
+    def _format_value(self, value):
+        return value
+
+
+class ImageHashCache(FileInfoCache):
+    """Persisted cache of MD5 hashes of images, saved as image_hashes.cache.tsv in the images directory."""
+    FILENAME = 'image_hashes.cache.tsv'
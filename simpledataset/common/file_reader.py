@@ -1,24 +1,167 @@
+import collections
+import mmap
+import os
 import pathlib
+import struct
+import threading
 import zipfile
+import zlib
+
+
+# crc is None for a normal file. mtime_ns is None for a zip entry.
+FileStat = collections.namedtuple('FileStat', ['size', 'crc', 'mtime_ns'])
+
+
+class MappedZipFile:
+    """Read-only zip file that serves entries directly from a memory map.
+
+    Stored (ZIP_STORED) entries are returned as memoryview slices of the file without copying. Deflated entries are
+    decompressed from the mapped bytes. The data offset of an entry is computed once from its local file header and
+    then cached. Since reads are positional and no file handle is kept open, an instance can be shared between threads
+    and forked processes.
+    """
+    _LOCAL_FILE_HEADER = struct.Struct('<4s22xHH')
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        with zipfile.ZipFile(filepath) as zip_file:
+            self._infos = {info.filename: info for info in zip_file.infolist()}
+        with open(filepath, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._data_ranges = {}
+
+    def getinfo(self, entry_name):
+        info = self._infos.get(entry_name)
+        if info is None:
+            raise KeyError(f"There is no item named {entry_name} in {self._filepath}")
+        return info
+
+    def read(self, entry_name):
+        info = self.getinfo(entry_name)
+
+        if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return self._read_with_zipfile(entry_name)
+
+        start, end = self._data_ranges.get(entry_name) or self._find_data_range(info)
+        if info.compress_type == zipfile.ZIP_STORED:
+            # The CRC is not checked here so that the data is not touched.
+            return self._view[start:end]
+
+        data = zlib.decompress(self._view[start:end], -zlib.MAX_WBITS)
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {entry_name} in {self._filepath}")
+        return data
+
+    def read_raw(self, entry_name):
+        """Returns (ZipInfo, compressed data as a memoryview) of a stored or deflated entry. Returns None for other entries."""
+        info = self.getinfo(entry_name)
+        if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return None
+
+        start, end = self._data_ranges.get(entry_name) or self._find_data_range(info)
+        return info, self._view[start:end]
+
+    def read_chunks(self, entry_name, chunk_size):
+        """Yield the entry's data in chunks so that the whole entry is not held in memory."""
+        info = self.getinfo(entry_name)
+        if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with zipfile.ZipFile(self._filepath) as zip_file, zip_file.open(entry_name) as f:
+                yield from iter(lambda: f.read(chunk_size), b'')
+            return
+
+        start, end = self._data_ranges.get(entry_name) or self._find_data_range(info)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if info.compress_type == zipfile.ZIP_DEFLATED else None
+        for offset in range(start, end, chunk_size):
+            chunk = self._view[offset:min(offset + chunk_size, end)]
+            yield decompressor.decompress(chunk) if decompressor else chunk
+        if decompressor:
+            yield decompressor.flush()
+
+    def _find_data_range(self, info):
+        """Returns (start, end) of the entry's data in the file."""
+        signature, filename_length, extra_length = self._LOCAL_FILE_HEADER.unpack_from(self._mmap, info.header_offset)
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Bad local file header for {info.filename} in {self._filepath}")
+
+        start = info.header_offset + self._LOCAL_FILE_HEADER.size + filename_length + extra_length
+        self._data_ranges[info.filename] = (start, start + info.compress_size)
+        return self._data_ranges[info.filename]
+
+    def _read_with_zipfile(self, entry_name):
+        # Rare compression methods are read through zipfile. Open the file for each read so that no handle is shared.
+        with zipfile.ZipFile(self._filepath) as zip_file:
+            return zip_file.read(entry_name)
 
 
 class FileReader:
-    """Read a file in <zip_filepath>@<entry_name> format, or a normal file path.."""
+    """Read a file in <zip_filepath>@<entry_name> format, or a normal file path..
+
+    In 'rb' mode, an uncompressed zip entry is returned as a memoryview without copying. Otherwise bytes are returned.
+    A FileReader can be used from multiple threads, and from processes forked or spawned after it is created.
+    """
     def __init__(self, base_dir):
         assert isinstance(base_dir, pathlib.Path)
         self._zip_objects = {}
         self._base_dir = base_dir
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled. The zip files are opened again in the new process.
+        return {'base_dir': self._base_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['base_dir'])
 
     def read(self, filepath, mode='r'):
         assert mode in ('r', 'rb')
 
         if '@' in filepath:
             zip_filepath, entrypath = filepath.split('@')
-            if zip_filepath not in self._zip_objects:
-                self._zip_objects[zip_filepath] = zipfile.ZipFile(self._base_dir / zip_filepath)
-
-            with self._zip_objects[zip_filepath].open(entrypath) as f:
-                return f.read().decode('utf-8') if mode == 'r' else f.read()
+            data = self._get_zip_object(zip_filepath).read(entrypath)
+            return str(data, 'utf-8') if mode == 'r' else data
         else:
             with open(self._base_dir / filepath, mode) as f:
                 return f.read()
+
+    def read_raw(self, filepath):
+        """Returns (ZipInfo, compressed data) if the file is a zip entry that can be copied as it is. Otherwise returns None."""
+        if '@' not in filepath:
+            return None
+        zip_filepath, entrypath = filepath.split('@')
+        return self._get_zip_object(zip_filepath).read_raw(entrypath)
+
+    def read_chunks(self, filepath, chunk_size=1024 * 1024):
+        """Yield the binary content of the file in chunks so that the whole file is not held in memory."""
+        if '@' in filepath:
+            zip_filepath, entrypath = filepath.split('@')
+            yield from self._get_zip_object(zip_filepath).read_chunks(entrypath, chunk_size)
+        else:
+            with open(self._base_dir / filepath, 'rb') as f:
+                yield from iter(lambda: f.read(chunk_size), b'')
+
+    def get_stat(self, filepath):
+        """Get a FileStat without reading the file. The CRC of a zip entry comes from the central directory."""
+        if '@' in filepath:
+            zip_filepath, entrypath = filepath.split('@')
+            info = self._get_zip_object(zip_filepath).getinfo(entrypath)
+            return FileStat(info.file_size, info.CRC, None)
+        else:
+            stat = os.stat(self._base_dir / filepath)
+            return FileStat(stat.st_size, None, stat.st_mtime_ns)
+
+    def _get_zip_object(self, zip_filepath):
+        zip_object = self._zip_objects.get(zip_filepath)
+        if zip_object:
+            return zip_object
+
+        if self._pid != os.getpid():
+            # The lock might have been held by another thread when this process was forked.
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+        with self._lock:
+            if zip_filepath not in self._zip_objects:
+                self._zip_objects[zip_filepath] = MappedZipFile(self._base_dir / zip_filepath)
+            return self._zip_objects[zip_filepath]
@@ -0,0 +1,65 @@
+import io
+import struct
+import PIL.Image
+from .file_cache import FileInfoCache
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# SOF markers except DHT (0xC4), JPG (0xC8) and DAC (0xCC).
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field.
+_JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+
+
+def get_image_size(image_binary):
+    """Get (width, height) of an image from its header without decoding the pixels.
+
+    JPEG and PNG headers are parsed directly. Other formats are opened by PIL, which reads only the header.
+    """
+    size = _get_png_size(image_binary) or _get_jpeg_size(image_binary)
+    if size:
+        return size
+
+    with PIL.Image.open(io.BytesIO(image_binary)) as image:
+        return image.size
+
+
+def _get_png_size(data):
+    if len(data) < 24 or bytes(data[:8]) != _PNG_SIGNATURE or bytes(data[12:16]) != b'IHDR':
+        return None
+    return struct.unpack_from('>II', data, 16)
+
+
+def _get_jpeg_size(data):
+    if len(data) < 4 or bytes(data[:2]) != b'\xff\xd8':
+        return None
+
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # Fill byte.
+            i += 1
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, i + 5)
+            return (width, height)
+        if marker == 0xDA:  # Start of scan. No SOF marker was found.
+            return None
+        i += 2 + struct.unpack_from('>H', data, i + 2)[0]
+    return None
+
+
+class ImageSizeCache(FileInfoCache):
+    """Persisted cache of image sizes, saved as image_sizes.cache.tsv in the images directory."""
+    FILENAME = 'image_sizes.cache.tsv'
+    NUM_VALUE_FIELDS = 2
+
+    def _parse_value(self, fields):
+        return (int(fields[0]), int(fields[1]))
+
+    def _format_value(self, value):
+        return f'{value[0]}\t{value[1]}'
@@ -0,0 +1,105 @@
+import json
+
+_WHITESPACES = ' \t\n\r'
+
+
+class JsonArrayStreamParser:
+    """Parse a JSON object in a file incrementally. The elements of the top-level arrays are decoded one by one.
+
+    Only the current element and a chunk of the text are kept in memory, so a large annotation file can be read without
+    building the whole object tree.
+    """
+    def __init__(self, fp, chunk_size=1024 * 1024):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def parse(self, handlers):
+        """Call handlers[key](element) for each element of the top-level arrays. The other values are skipped.
+
+        Returns:
+            A dict of the skipped top-level values.
+        """
+        others = {}
+        self._expect('{')
+        if self._peek() == '}':
+            self._expect('}')
+            return others
+
+        while True:
+            key = self._decode()
+            self._expect(':')
+            if key in handlers and self._peek() == '[':
+                self._parse_array(handlers[key])
+            else:
+                others[key] = self._decode()
+
+            if self._next() == '}':
+                return others
+
+    def _parse_array(self, handler):
+        self._expect('[')
+        if self._peek() == ']':
+            self._expect(']')
+            return
+
+        while True:
+            handler(self._decode())
+            if self._next() == ']':
+                return
+
+    def _fill(self):
+        """Read the next chunk. Returns False at the end of the file."""
+        if self._eof:
+            return False
+        chunk = self._fp.read(self._chunk_size)
+        if not chunk:
+            # The buffer is kept as it is so that the positions in it are still valid.
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACES:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of the JSON file.")
+
+    def _next(self):
+        c = self._peek()
+        if c not in ',]}':
+            raise ValueError(f"Unexpected character in the JSON file: {c}")
+        self._pos += 1
+        return c
+
+    def _expect(self, expected):
+        c = self._peek()
+        if c != expected:
+            raise ValueError(f"Expected {expected} in the JSON file, but got {c}")
+        self._pos += 1
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            # A number near the end of the buffer might continue in the next chunk, e.g. "2017" + ".5" or "1e" + "-3".
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if (end == len(self._buffer) or (is_number and end + 2 >= len(self._buffer))) and self._fill():
+                continue
+
+            self._pos = end
+            return value
@@ -0,0 +1,51 @@
+import zipfile
+import numpy as np
+
+
+class PackedLabelFile:
+    """Labels of all images in a single labels.npz file, as an alternative to a label file per image in labels.zip.
+
+    The file has the int64 'offsets' array and the N x 5 (Object Detection) or N x 11 (Visual Relationship) int32
+    'annotations' array. The labels of the i-th entry are annotations[offsets[i]:offsets[i + 1]]. The main txt refers
+    to the entry as <npz_filepath>#<index>.
+    """
+    SEPARATOR = '#'
+
+    def __init__(self, filepath):
+        with np.load(filepath, allow_pickle=False) as data:
+            self._offsets = data['offsets']
+            self._annotations = data['annotations']
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._annotations[self._offsets[index]:self._offsets[index + 1]]
+
+    @property
+    def num_columns(self):
+        return self._annotations.shape[1]
+
+    @staticmethod
+    def read_num_columns(filepath):
+        """Get the number of columns of the annotations by reading only the header of the array."""
+        with zipfile.ZipFile(filepath) as zf, zf.open('annotations.npy') as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape = read_header(f)[0]
+        return shape[1] if len(shape) == 2 else None
+
+    @classmethod
+    def is_packed_label(cls, label_field):
+        return cls.SEPARATOR in label_field
+
+    @classmethod
+    def parse_label_field(cls, label_field):
+        """Returns (npz_filepath, index) of a label field in <npz_filepath>#<index> format."""
+        filepath, index = label_field.rsplit(cls.SEPARATOR, 1)
+        return filepath, int(index)
+
+    @staticmethod
+    def save(filepath, offsets, annotations):
+        with open(filepath, 'wb') as f:
+            np.savez(f, offsets=np.asarray(offsets, dtype=np.int64), annotations=np.asarray(annotations, dtype=np.int32))
@@ -0,0 +1,37 @@
+import collections
+import concurrent.futures
+import multiprocessing
+
+# Worker processes are not forked since forking while other threads are running, e.g. readers of imap_ordered, can deadlock.
+_MP_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def imap_ordered(func, iterable, num_workers, max_prefetch=None, use_processes=False):
+    """Apply func to each item on a thread pool and yield the results in the input order.
+
+    At most max_prefetch items are processed ahead of the consumer, so the memory usage is bounded. If num_workers is 1
+    or less, items are processed in the calling thread. If use_processes is True, a process pool is used for CPU bound
+    work. Then func and the items must be picklable, and func must be importable by the worker processes.
+    """
+    if num_workers <= 1:
+        yield from map(func, iterable)
+        return
+
+    max_prefetch = max_prefetch or num_workers * 4
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context(_MP_START_METHOD))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+    with executor:
+        futures = collections.deque()
+        try:
+            for item in iterable:
+                futures.append(executor.submit(func, item))
+                if len(futures) >= max_prefetch:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for f in futures:
+                f.cancel()
@@ -0,0 +1,37 @@
+import zipfile
+
+
+def write_raw_entry(zip_file, entry_name, source_info, raw_data, chunk_size=1024 * 1024):
+    """Add already compressed data of a zip entry to zip_file without decompressing and compressing it again.
+
+    zipfile has no public API for this. The local file header and the data are written in the same way as
+    ZipFile.open(mode='w') does, with the CRC and the sizes copied from source_info.
+
+    Args:
+        zip_file (zipfile.ZipFile): A seekable ZipFile opened in 'w' mode.
+        source_info (zipfile.ZipInfo): The ZipInfo of the source entry.
+        raw_data: The compressed data of the source entry. It is written in chunks of chunk_size bytes.
+    """
+    info = zipfile.ZipInfo(entry_name, date_time=source_info.date_time)
+    info.compress_type = source_info.compress_type
+    info.CRC = source_info.CRC
+    info.compress_size = source_info.compress_size
+    info.file_size = source_info.file_size
+    info.external_attr = source_info.external_attr or (0o600 << 16)
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+
+    with zip_file._lock:
+        if zip_file._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        zip_file.fp.seek(zip_file.start_dir)
+        info.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(info)
+        zip_file._didModify = True
+
+        zip_file.fp.write(info.FileHeader(zip64))
+        for offset in range(0, len(raw_data), chunk_size):
+            zip_file.fp.write(raw_data[offset:offset + chunk_size])
+
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(info)
+        zip_file.NameToInfo[info.filename] = info
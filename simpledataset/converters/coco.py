@@ -1,9 +1,13 @@
-import collections
+import array
 import json
 import logging
 import pathlib
+import numpy as np
 import tqdm
-from simpledataset.common import ObjectDetectionDataset
+from simpledataset.common import AnnotationStore, ObjectDetectionDataset
+from simpledataset.common.image_size import get_image_size
+from simpledataset.common.json_stream import JsonArrayStreamParser
+from simpledataset.common.parallel import imap_ordered
 
 
 logger = logging.getLogger(__name__)
@@ -11,35 +15,59 @@ logger = logging.getLogger(__name__)
 
 class CocoReader:
     def read(self, input_json_filepath, input_images_dir, **args):
-        data = json.loads(input_json_filepath.read_text())
+        # The json file is parsed incrementally, and the boxes are kept in compact arrays instead of Python objects.
+        image_id_indexes = {}  # COCO image id => index in the order of appearance.
+        images = []  # (index of the image id, file name)
+        box_image_ids = array.array('q')
+        boxes = array.array('i')
+        categories = []
 
-        image_map = {}
-        for image in data['images']:
-            image_map[image['id']] = image['file_name']
+        def add_image(image):
+            images.append((image_id_indexes.setdefault(image['id'], len(image_id_indexes)), image['file_name']))
 
-        dataset_data = []
-        annotations = collections.defaultdict(list)
-        for annotation in data['annotations']:
+        def add_annotation(annotation):
             bbox = annotation['bbox']
             new_label = (annotation['category_id'], int(bbox[0]), int(bbox[1]), int(bbox[0]+bbox[2]), int(bbox[1]+bbox[3]))
             if new_label[1] == new_label[3] or new_label[2] == new_label[4]:
                 logger.warning(f"Image {annotation['image_id']} has an invalid bounding box: {new_label}. Skipping...")
-                continue
+                return
+
+            box_image_ids.append(image_id_indexes.setdefault(annotation['image_id'], len(image_id_indexes)))
+            boxes.extend(new_label)
 
-            if new_label in annotations[annotation['image_id']]:
-                logger.warning(f"Image {annotation['image_id']} has duplicated bounding boxes: {new_label}.")
-                continue
+        with open(input_json_filepath, encoding='utf-8') as f:
+            JsonArrayStreamParser(f).parse({'images': add_image, 'annotations': add_annotation, 'categories': categories.append})
 
-            annotations[annotation['image_id']].append(new_label)
+        box_image_ids = np.frombuffer(box_image_ids, dtype=np.int64)
+        boxes = np.frombuffer(boxes, dtype=np.int32).reshape(-1, 5)
+        keep = self._find_unique_boxes(box_image_ids, boxes, list(image_id_indexes))
 
-        for image in data['images']:
-            image_filename = image['file_name']
-            labels = annotations[image['id']]
+        # Group the boxes by image id, and then arrange them in the order of the images list. The order of boxes in an
+        # image is kept.
+        box_image_ids = box_image_ids[keep]
+        order = np.argsort(box_image_ids, kind='stable')
+        offsets = np.zeros(len(image_id_indexes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(box_image_ids, minlength=len(image_id_indexes)), out=offsets[1:])
+        boxes_by_id = AnnotationStore([None] * len(image_id_indexes), offsets, boxes[keep][order])
+        boxes_by_image = boxes_by_id.take([i for i, _ in images])
 
-            dataset_data.append((image_filename, labels))
+        store = AnnotationStore([file_name for _, file_name in images], boxes_by_image.offsets, boxes_by_image.annotations)
+        label_names = self._get_labels(categories)
+        return ObjectDetectionDataset(store, input_images_dir, label_names=label_names)
 
-        label_names = self._get_labels(data['categories'])
-        return ObjectDetectionDataset(dataset_data, input_images_dir, label_names=label_names)
+    @staticmethod
+    def _find_unique_boxes(box_image_ids, boxes, image_ids):
+        """Get a mask of the boxes that are not duplicated in the same image. The first one of the duplicates is kept."""
+        keep = np.ones(len(boxes), dtype=bool)
+        if not len(boxes):
+            return keep
+
+        _, first_indexes = np.unique(np.column_stack((box_image_ids, boxes)), axis=0, return_index=True)
+        keep[:] = False
+        keep[first_indexes] = True
+        for i in np.flatnonzero(~keep):
+            logger.warning(f"Image {image_ids[box_image_ids[i]]} has duplicated bounding boxes: {tuple(boxes[i].tolist())}.")
+        return keep
 
     @staticmethod
     def add_arguments(parser):
@@ -54,43 +82,49 @@ class CocoReader:
 
 
 class CocoWriter:
-    def write(self, dataset, output_filepath, images_dir, **kwargs):
+    def write(self, dataset, output_filepath, images_dir, num_workers=1, **kwargs):
+        """Copy the images and write the COCO json incrementally.
+
+        The images are read, copied and measured on a thread pool. The json is written while the images are copied, and
+        the annotations are written in a second pass over the labels, so the whole COCO dict is never built in memory.
+        """
         assert dataset.type == 'object_detection'
 
-        annotations = []
-        images = []
-        annotation_index = len(dataset)
-        for i, (image_filename, labels) in enumerate(tqdm.tqdm(dataset, "Copying images")):
-            for class_id, x, y, x2, y2 in labels:
-                area = (x2 - x) * (y2 - y)
-                annotations.append({'id': annotation_index,
-                                    'image_id': i,
-                                    'category_id': class_id + 1,  # COCO class_id is 1-indexed in the official dataset file.
-                                    'area': area,
-                                    'bbox': [x, y, x2 - x, y2 - y],
-                                    'iscrowd': 0})
-                annotation_index += 1
-
-            image = dataset.load_image(image_filename)
+        def copy_image(item):
+            i, image_filename = item
+            image_binary = dataset.read_image_binary(image_filename)
             ext = image_filename.split('.')[-1]
             new_filename = f'{i}.{ext}'
-            images.append({'id': i,
-                           'width': image.width,
-                           'height': image.height,
-                           'file_name': new_filename
-                           })
-
-            image_binary = dataset.read_image_binary(image_filename)
             (images_dir / new_filename).write_bytes(image_binary)
-
-        categories = []
-        for i, label in enumerate(dataset.get_labels()):
-            # 1-indexed category id.
-            categories.append({'id': i + 1, 'name': label, 'supercategory': 'none'})
-
-        coco_data = {'info': {}, 'images': images, 'annotations': annotations, 'categories': categories}
-
-        output_filepath.write_text(json.dumps(coco_data))
+            width, height = get_image_size(image_binary)
+            return {'id': i, 'width': width, 'height': height, 'file_name': new_filename}
+
+        with open(output_filepath, 'w') as f:
+            f.write('{"info": {}, "images": [')
+            image_filenames = enumerate(image_filename for image_filename, _ in dataset)
+            images = imap_ordered(copy_image, image_filenames, num_workers)
+            for i, image in enumerate(tqdm.tqdm(images, "Copying images", total=len(dataset))):
+                f.write((', ' if i else '') + json.dumps(image))
+
+            f.write('], "annotations": [')
+            annotation_index = len(dataset)
+            for i, (_, labels) in enumerate(dataset):
+                for class_id, x, y, x2, y2 in labels:
+                    area = (x2 - x) * (y2 - y)
+                    annotation = {'id': annotation_index,
+                                  'image_id': i,
+                                  'category_id': class_id + 1,  # COCO class_id is 1-indexed in the official dataset file.
+                                  'area': area,
+                                  'bbox': [x, y, x2 - x, y2 - y],
+                                  'iscrowd': 0}
+                    f.write((', ' if annotation_index > len(dataset) else '') + json.dumps(annotation))
+                    annotation_index += 1
+
+            categories = []
+            for i, label in enumerate(dataset.get_labels()):
+                # 1-indexed category id.
+                categories.append({'id': i + 1, 'name': label, 'supercategory': 'none'})
+            f.write('], "categories": ' + json.dumps(categories) + '}')
 
     @staticmethod
     def add_arguments(parser):
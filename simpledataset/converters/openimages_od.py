@@ -1,61 +1,64 @@
 import collections
 import csv
+import itertools
 import logging
 import pathlib
+import numpy as np
 import PIL.Image
 import tqdm
-from simpledataset.common import ObjectDetectionDataset
+from simpledataset.common import AnnotationStore, ObjectDetectionDataset
+from simpledataset.common.file_reader import FileReader
+from simpledataset.common.image_size import ImageSizeCache
+from simpledataset.common.parallel import imap_ordered
 
 
 logger = logging.getLogger(__name__)
 
 
 class OpenImagesODReader:
-    def read(self, bbox_csv_filepath, openimages_images_dir, include_occluded=True, include_depiction=False, include_inside=False, **args):
+    def read(self, bbox_csv_filepath, openimages_images_dir, include_occluded=True, include_depiction=False, include_inside=False, num_workers=1, **args):
         """
         Args:
              bbox_csv_filepath (pathlib.Path): Filepath to annotation-bbox.csv.
              images_dir (pathlib.Path): The directory contains image files.
+             num_workers (int): The number of threads to get the image sizes.
         """
-        annotations = collections.defaultdict(list)
-        image_sizes = {}
-        label_name_set = set()
+        size_cache = ImageSizeCache(openimages_images_dir)
+        image_index_map = {}
+        image_infos = []
+        label_chunks = []  # (unique label names, label index of each box)
+        image_index_chunks = []
+        box_chunks = []
         total_count = 0
-        box_count = 0
-        with open(bbox_csv_filepath, newline='') as f:
-            reader = csv.DictReader(f)
-            for row in tqdm.tqdm(reader):
-                total_count += 1
-                image_id = row['ImageID']
-                label_name = row['LabelName']
-                label_name_set.add(label_name)
-                if image_id not in image_sizes:
-                    image_sizes[image_id] = self._get_image_size(openimages_images_dir, image_id)
-                w, h = image_sizes[image_id]
-                if not include_occluded and row.get('IsOccluded') == '1':
-                    continue
-                if not include_depiction and row.get('IsDepiction') == '1':
-                    continue
-                if not include_inside and row.get('IsInside') == '1':
-                    continue
-
-                box_count += 1
-                annotations[image_id].append((label_name,
-                                              int(round(float(row['XMin']) * w)), int(round(float(row['YMin']) * h)),
-                                              int(round(float(row['XMax']) * w)), int(round(float(row['YMax']) * h))))
-
+        column_dtypes = {'ImageID': str, 'LabelName': str, 'XMin': np.float64, 'YMin': np.float64, 'XMax': np.float64, 'YMax': np.float64,
+                         'IsOccluded': str, 'IsDepiction': str, 'IsInside': str}
+        with tqdm.tqdm(unit='rows', disable=None) as progress:
+            for columns in self._read_csv_chunks(bbox_csv_filepath, column_dtypes):
+                num_rows = len(columns['ImageID'])
+                total_count += num_rows
+                image_indexes, image_sizes = self._get_image_sizes(openimages_images_dir, columns['ImageID'], image_index_map, image_infos, size_cache, num_workers)
+                label_names, label_indexes = np.unique(columns['LabelName'], return_inverse=True)
+
+                keep = np.ones(num_rows, dtype=bool)
+                for column_name, include in (('IsOccluded', include_occluded), ('IsDepiction', include_depiction), ('IsInside', include_inside)):
+                    if not include and column_name in columns:
+                        keep &= columns[column_name] != '1'
+
+                label_chunks.append((label_names, label_indexes[keep]))
+                image_index_chunks.append(image_indexes[keep])
+                box_chunks.append(self._scale_boxes(columns, ['XMin', 'YMin', 'XMax', 'YMax'], image_sizes)[keep])
+                progress.update(num_rows)
+
+        size_cache.save()
+        box_count = sum(len(b) for b in box_chunks)
         logger.info(f"Total number of boxes is {total_count}. Skipped {total_count - box_count}.")
 
-        label_names = sorted(label_name_set)
+        label_names = sorted(set(n for names, _ in label_chunks for n in names.tolist()))
         label_id_map = {n: i for i, n in enumerate(label_names)}
-
-        dataset_data = []
-        for image_id in annotations:
-            image_filename = self._resolve_image_filename(openimages_images_dir, image_id)
-            labels = [(label_id_map[a[0]], *a[1:]) for a in annotations[image_id]]
-            dataset_data.append((image_filename, labels))
-
-        return ObjectDetectionDataset(dataset_data, openimages_images_dir, label_names=label_names)
+        class_ids = self._concatenate([self._get_ids(names, indexes, label_id_map) for names, indexes in label_chunks], np.int32)
+        boxes = np.column_stack((class_ids, self._concatenate(box_chunks, np.int32).reshape(-1, 4)))
+        store = self._make_store(image_infos, self._concatenate(image_index_chunks, np.int64), boxes)
+        return ObjectDetectionDataset(store, openimages_images_dir, label_names=label_names)
 
     @staticmethod
     def add_arguments(parser):
@@ -78,13 +81,94 @@ class OpenImagesODReader:
         return None
 
     @staticmethod
-    def _get_image_size(images_dir, image_id):
+    def _get_image_info(images_dir, image_id, size_cache=None):
+        """Get (filename, (width, height)) of the image."""
         filename = OpenImagesODReader._resolve_image_filename(images_dir, image_id)
         if not filename:
             raise RuntimeError(f"Image is not found: {image_id}")
 
+        if size_cache:
+            fingerprint = ImageSizeCache.get_fingerprint(FileReader(images_dir).get_stat(filename))
+            size = size_cache.get(filename, fingerprint)
+            if size:
+                return filename, size
+
+        # PIL reads only the header until the pixels are accessed.
         with PIL.Image.open(images_dir / filename) as image:
-            return (image.width, image.height)
+            size = (image.width, image.height)
+
+        if size_cache:
+            size_cache.set(filename, fingerprint, size)
+        return filename, size
+
+    @staticmethod
+    def _read_csv_chunks(csv_filepath, column_dtypes, chunk_size=100000):
+        """Yield {column name: array} for each chunk of rows.
+
+        Args:
+            column_dtypes: {column name: dtype}. Only these columns are parsed. Columns that don't exist in the file are ignored.
+        """
+        with open(csv_filepath) as f:
+            header = next(csv.reader([f.readline()]), [])
+            dtype_columns = collections.defaultdict(list)
+            for name, dtype in column_dtypes.items():
+                if name in header:
+                    dtype_columns[dtype].append(name)
+
+            while True:
+                lines = list(itertools.islice(f, chunk_size))
+                if not lines:
+                    break
+                columns = {}
+                # Parse the columns of each dtype at once so that numbers are converted directly by the C parser.
+                for dtype, names in dtype_columns.items():
+                    values = np.loadtxt(lines, delimiter=',', quotechar='"', comments=None, dtype=dtype, usecols=[header.index(n) for n in names], ndmin=2)
+                    columns.update((n, values[:, i]) for i, n in enumerate(names))
+                yield columns
+
+    @staticmethod
+    def _get_image_sizes(images_dir, image_ids, image_index_map, image_infos, size_cache, num_workers):
+        """Get the image index and (width, height) of each row.
+
+        Images that are not in image_index_map are resolved and measured on a thread pool, and added to image_infos.
+        """
+        unique_image_ids, inverse = np.unique(image_ids, return_inverse=True)
+        unique_image_ids = unique_image_ids.tolist()
+        new_image_ids = [i for i in unique_image_ids if i not in image_index_map]
+        new_image_infos = imap_ordered(lambda i: OpenImagesODReader._get_image_info(images_dir, i, size_cache), new_image_ids, num_workers)
+        for image_id, image_info in zip(new_image_ids, new_image_infos):
+            image_index_map[image_id] = len(image_infos)
+            image_infos.append(image_info)
+
+        image_indexes = np.array([image_index_map[i] for i in unique_image_ids], dtype=np.int64)
+        image_sizes = np.array([image_infos[i][1] for i in image_indexes.tolist()], dtype=np.float64).reshape(-1, 2)
+        return image_indexes[inverse], image_sizes[inverse]
+
+    @staticmethod
+    def _scale_boxes(columns, column_names, image_sizes):
+        """Convert the relative coordinates in the float columns into pixels. The columns alternate between x and y."""
+        coordinates = [columns[n] * image_sizes[:, i % 2] for i, n in enumerate(column_names)]
+        return np.rint(np.column_stack(coordinates)).astype(np.int32)
+
+    @staticmethod
+    def _get_ids(names, indexes, label_id_map):
+        return np.array([label_id_map[n] for n in names.tolist()], dtype=np.int32)[indexes]
+
+    @staticmethod
+    def _concatenate(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+    @staticmethod
+    def _make_store(image_infos, image_indexes, annotations):
+        """Make an AnnotationStore whose images are in the order of their first annotation."""
+        unique_image_indexes, first_indexes = np.unique(image_indexes, return_index=True)
+        image_order = unique_image_indexes[np.argsort(first_indexes)]
+        ranks = np.zeros(len(image_infos), dtype=np.int64)
+        ranks[image_order] = np.arange(len(image_order))
+        box_ranks = ranks[image_indexes]
+        offsets = np.zeros(len(image_order) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(box_ranks, minlength=len(image_order)), out=offsets[1:])
+        return AnnotationStore([image_infos[i][0] for i in image_order.tolist()], offsets, annotations[np.argsort(box_ranks, kind='stable')])
 
 
 class OpenImagesODWriter:
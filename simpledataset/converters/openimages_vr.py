@@ -1,9 +1,9 @@
-import collections
-import csv
 import logging
 import pathlib
+import numpy as np
 import tqdm
 from simpledataset.common import VisualRelationshipDataset
+from simpledataset.common.image_size import ImageSizeCache
 from simpledataset.converters.openimages_od import OpenImagesODReader
 
 
@@ -11,54 +11,46 @@ logger = logging.getLogger(__name__)
 
 
 class OpenImagesVRReader:
-    def read(self, bbox_csv_filepath, openimages_images_dir, **args):
+    def read(self, bbox_csv_filepath, openimages_images_dir, num_workers=1, **args):
         """
         Args:
              bbox_csv_filepath (pathlib.Path): Filepath to annotation-bbox.csv.
              images_dir (pathlib.Path): The directory contains image files.
+             num_workers (int): The number of threads to get the image sizes.
         """
         logger.warning("Note that this converter doesn't copy image files.")
 
-        annotations = collections.defaultdict(list)
-        image_sizes = {}
-        label_name_set = set()
-        relationship_set = set()
-        with open(bbox_csv_filepath, newline='') as f:
-            reader = csv.DictReader(f)
-            for row in tqdm.tqdm(reader):
-                image_id = row['ImageID']
-                label_name1 = row['LabelName1']
-                label_name2 = row['LabelName2']
-                relationship_label = row['RelationshipLabel']
-
-                label_name_set.add(label_name1)
-                label_name_set.add(label_name2)
-                relationship_set.add(relationship_label)
-
-                if image_id not in image_sizes:
-                    image_sizes[image_id] = OpenImagesODReader._get_image_size(openimages_images_dir, image_id)
-                w, h = image_sizes[image_id]
-
-                annotations[image_id].append((label_name1,
-                                              int(round(float(row['XMin1']) * w)), int(round(float(row['YMin1']) * h)),
-                                              int(round(float(row['XMax1']) * w)), int(round(float(row['YMax1']) * h)),
-                                              label_name2,
-                                              int(round(float(row['XMin2']) * w)), int(round(float(row['YMin2']) * h)),
-                                              int(round(float(row['XMax2']) * w)), int(round(float(row['YMax2']) * h)),
-                                              relationship_label))
-
-        logger.info(f"Loaded {len(annotations)} annotations and {len(image_sizes)} images.")
-
-        label_names = sorted(label_name_set) + sorted(relationship_set)
+        size_cache = ImageSizeCache(openimages_images_dir)
+        image_index_map = {}
+        image_infos = []
+        label_chunks = {'LabelName1': [], 'LabelName2': [], 'RelationshipLabel': []}
+        image_index_chunks = []
+        box_chunks = []
+        box_column_names = ['XMin1', 'YMin1', 'XMax1', 'YMax1', 'XMin2', 'YMin2', 'XMax2', 'YMax2']
+        column_dtypes = {'ImageID': str, **{n: str for n in label_chunks}, **{n: np.float64 for n in box_column_names}}
+        with tqdm.tqdm(unit='rows', disable=None) as progress:
+            for columns in OpenImagesODReader._read_csv_chunks(bbox_csv_filepath, column_dtypes):
+                image_indexes, image_sizes = OpenImagesODReader._get_image_sizes(openimages_images_dir, columns['ImageID'], image_index_map, image_infos, size_cache, num_workers)
+                for column_name, chunks in label_chunks.items():
+                    chunks.append(np.unique(columns[column_name], return_inverse=True))
+                image_index_chunks.append(image_indexes)
+                box_chunks.append(OpenImagesODReader._scale_boxes(columns, box_column_names, image_sizes))
+                progress.update(len(image_indexes))
+
+        size_cache.save()
+
+        def get_names(column_names):
+            return set(n for c in column_names for names, _ in label_chunks[c] for n in names.tolist())
+
+        label_names = sorted(get_names(['LabelName1', 'LabelName2'])) + sorted(get_names(['RelationshipLabel']))
         label_id_map = {n: i for i, n in enumerate(label_names)}
-
-        dataset_data = []
-        for image_id in annotations:
-            image_filename = OpenImagesODReader._resolve_image_filename(openimages_images_dir, image_id)
-            labels = [(label_id_map[a[0]], *a[1:5], label_id_map[a[5]], *a[6:10], label_id_map[a[10]]) for a in annotations[image_id]]
-            dataset_data.append((image_filename, labels))
-
-        return VisualRelationshipDataset(dataset_data, openimages_images_dir, label_names=label_names)
+        class_ids = {c: OpenImagesODReader._concatenate([OpenImagesODReader._get_ids(names, indexes, label_id_map) for names, indexes in chunks], np.int32)
+                     for c, chunks in label_chunks.items()}
+        boxes = OpenImagesODReader._concatenate(box_chunks, np.int32).reshape(-1, 8)
+        annotations = np.column_stack((class_ids['LabelName1'], boxes[:, :4], class_ids['LabelName2'], boxes[:, 4:], class_ids['RelationshipLabel']))
+        store = OpenImagesODReader._make_store(image_infos, OpenImagesODReader._concatenate(image_index_chunks, np.int64), annotations)
+        logger.info(f"Loaded {len(store)} annotations and {len(image_infos)} images.")
+        return VisualRelationshipDataset(store, openimages_images_dir, label_names=label_names)
 
     @staticmethod
     def add_arguments(parser):
@@ -1,9 +1,13 @@
 """Change the task of the dataset. For example, OD => IC.
 """
+import io
+import itertools
 import logging
 import zipfile
+import PIL.Image
 import tqdm
 from simpledataset.common import ImageClassificationDataset, ObjectDetectionDataset
+from simpledataset.common.parallel import imap_ordered
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +24,36 @@ def _make_unique_filepath(filepath):
     raise RuntimeError(f"Failed to find a unique filename for {filepath}")
 
 
+def _crop_boxes(item):
+    """Crop the boxes from an image and encode them into JPEG. Runs in a worker process.
+
+    Args:
+        item: (image binary, list of (x, y, x2, y2))
+    Returns:
+        ((width, height), list of JPEG binaries). The binary is None if the box is out of the image.
+    """
+    image_binary, boxes = item
+    with io.BytesIO(image_binary) as f:
+        pil_image = PIL.Image.open(f)
+        pil_image.load()
+
+    crops = []
+    for x, y, x2, y2 in boxes:
+        if x >= pil_image.width or y >= pil_image.height or x2 <= 0 or y2 <= 0 or x >= x2 or y >= y2:
+            crops.append(None)
+            continue
+
+        cropped_image = pil_image.crop((max(x, 0), max(y, 0), min(x2, pil_image.width), min(y2, pil_image.height)))
+        with io.BytesIO() as f:
+            cropped_image.save(f, format='JPEG')
+            crops.append(f.getvalue())
+
+    return pil_image.size, crops
+
+
 class TaskConverter:
-    def convert(self, dataset, destination_dataset_type, output_directory):
+    def convert(self, dataset, destination_dataset_type, output_directory, num_workers=1, use_cache=False):
+        """Convert the dataset into destination_dataset_type. If use_cache is True, image sizes are cached in the images directory."""
         ROUTES = {('visual_relationship', 'object_detection'): [self._convert_vr_od],
                   ('visual_relationship', 'image_classification'): [self._convert_vr_od, self._convert_od_ic],
                   ('object_detection', 'image_classification'): [self._convert_od_ic],
@@ -33,41 +65,44 @@ class TaskConverter:
             raise RuntimeError(f"Cannot ocnvert {source_dataset_type} into {destination_dataset_type}")
 
         for c in converters:
-            dataset = c(dataset, output_directory)
+            dataset = c(dataset, output_directory, num_workers, use_cache)
 
         return dataset
 
-    def _convert_od_ic(self, dataset, output_directory):
-        # Crop Bounding Box and make it into classification dataset.
+    def _convert_od_ic(self, dataset, output_directory, num_workers, use_cache):
+        # Crop Bounding Box and make it into classification dataset. Images are decoded, cropped and encoded in worker
+        # processes, and the crops are written into the zip file in the original order.
         data = []
         images_zip_filepath = _make_unique_filepath(output_directory / 'images.zip')
         images_zip_filename = images_zip_filepath.name
         index = 0
+
+        def read_item(item):
+            # A memoryview of a mapped zip file cannot be sent to the worker processes.
+            image, labels = item
+            return bytes(dataset.read_image_binary(image)), [label[1:] for label in labels]
+
+        dataset_iter, items = itertools.tee(dataset)
+        image_binaries = imap_ordered(read_item, items, num_workers)
+        results = imap_ordered(_crop_boxes, image_binaries, num_workers, use_processes=True)
         with zipfile.ZipFile(images_zip_filepath, mode='w', compression=zipfile.ZIP_STORED) as f:
-            for image, labels in tqdm.tqdm(dataset, "Cropping images", disable=None):
-                pil_image = dataset.load_image(image)
-                for label in labels:
+            for (image, labels), (image_size, crops) in tqdm.tqdm(zip(dataset_iter, results), "Cropping images", total=len(dataset), disable=None):
+                for label, crop in zip(labels, crops):
                     x, y, x2, y2 = label[1:]
-                    if x >= pil_image.width or y >= pil_image.height or x2 <= 0 or y2 <= 0 or x >= x2 or y >=y2:
-                        logger.warning(f"Invalid box detected: {x} {y} {x2} {y2} for image (w {pil_image.width} x h {pil_image.height})")
+                    if crop is None:
+                        logger.warning(f"Invalid box detected: {x} {y} {x2} {y2} for image (w {image_size[0]} x h {image_size[1]})")
                         continue
 
-                    if x < 0 or y < 0 or x2 > pil_image.width or y2 > pil_image.height:
-                        logger.debug(f"Invalid box detected: {x} {y} {x2} {y2} for image (w {pil_image.width} x h {pil_image.height})")
-                        x = max(x, 0)
-                        y = max(y, 0)
-                        x2 = min(x2, pil_image.width)
-                        y2 = min(y2, pil_image.height)
+                    if x < 0 or y < 0 or x2 > image_size[0] or y2 > image_size[1]:
+                        logger.debug(f"Invalid box detected: {x} {y} {x2} {y2} for image (w {image_size[0]} x h {image_size[1]})")
 
-                    cropped_image = pil_image.crop((x, y, x2, y2))
-                    with f.open(f'{index}.jpg', 'w') as zf:
-                        cropped_image.save(zf, format='JPEG')
+                    f.writestr(f'{index}.jpg', crop)
                     data.append((f'{images_zip_filename}@{index}.jpg', [label[0]]))
                     index += 1
 
         return ImageClassificationDataset(data, output_directory, label_names=dataset.labels)
 
-    def _convert_vr_od(self, dataset, output_directory):
+    def _convert_vr_od(self, dataset, output_directory, num_workers, use_cache):
         def convert_label(label):
             x = min(label[1], label[6])
             y = min(label[2], label[7])
@@ -78,11 +113,7 @@ class TaskConverter:
         data = [(image, [convert_label(x) for x in labels]) for image, labels in dataset]
         return ObjectDetectionDataset(data, output_directory, label_names=dataset.labels, images_directory=dataset.base_images_directory)
 
-    def _convert_ic_od(self, dataset, output_directory):
-        def convert_labels(image, labels):
-            image = dataset.load_image(image)
-            w, h = image.size
-            return [(x, 0, 0, w, h) for x in labels]
-
-        data = [(image, convert_labels(image, labels)) for image, labels in dataset]
+    def _convert_ic_od(self, dataset, output_directory, num_workers, use_cache):
+        image_sizes = dataset.get_image_sizes([image for image, _ in dataset], num_workers, use_cache)
+        data = [(image, [(x, 0, 0, w, h) for x in labels]) for (image, labels), (w, h) in zip(dataset, image_sizes)]
         return ObjectDetectionDataset(data, output_directory, label_names=dataset.labels, images_directory=dataset.base_images_directory)
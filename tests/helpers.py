@@ -0,0 +1,21 @@
+import io
+import zipfile
+import PIL.Image
+
+
+def create_od_dataset(directory, num_images, labels_txt=True):
+    """Create an Object Detection dataset whose images and labels are stored in images.zip and labels.zip."""
+    lines = []
+    with zipfile.ZipFile(directory / 'images.zip', 'w') as images_zip, zipfile.ZipFile(directory / 'labels.zip', 'w') as labels_zip:
+        for i in range(num_images):
+            with io.BytesIO() as f:
+                PIL.Image.new('RGB', (32, 32), color=(i % 256, 0, 0)).save(f, format='JPEG')
+                images_zip.writestr(f'{i}.jpg', f.getvalue())
+            labels_zip.writestr(f'{i}.txt', f'{i % 3} 1 2 {10 + i % 20} 20\n')
+            lines.append(f'images.zip@{i}.jpg labels.zip@{i}.txt')
+
+    main_txt_filepath = directory / 'images.txt'
+    main_txt_filepath.write_text('\n'.join(lines) + '\n')
+    if labels_txt:
+        (directory / 'labels.txt').write_text('a\nb\nc\n')
+    return main_txt_filepath
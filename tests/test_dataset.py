@@ -0,0 +1,71 @@
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+from simpledataset.common import SimpleDatasetFactory
+from simpledataset.common.dataset import ObjectDetectionLabelLoader
+from simpledataset.common.dataset_cache import DatasetCache
+from tests.helpers import create_od_dataset
+
+
+class TestLazyDataset(unittest.TestCase):
+    def test_decode_only_accessed_entries(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 50)
+            with unittest.mock.patch.object(ObjectDetectionLabelLoader, 'load', autospec=True, side_effect=ObjectDetectionLabelLoader.load) as load:
+                dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True)
+                self.assertEqual(dataset.labels, ['a', 'b', 'c'])
+                self.assertEqual(load.call_count, 0)
+
+                self.assertEqual(dataset[3], ('images.zip@3.jpg', [(0, 1, 2, 13, 20)]))
+                self.assertEqual(dataset[-1], ('images.zip@49.jpg', [(1, 1, 2, 19, 20)]))
+                self.assertEqual(load.call_count, 2)
+
+    def test_same_as_eager_load(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 10)
+            lazy_dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True)
+            dataset = SimpleDatasetFactory().load(main_txt_filepath)
+            self.assertEqual(list(lazy_dataset), list(dataset))
+            self.assertEqual(lazy_dataset.labels, dataset.labels)
+
+
+class TestDatasetCache(unittest.TestCase):
+    def test_lazy_load_creates_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 10)
+            dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True, use_cache=True)
+            self.assertTrue(main_txt_filepath.with_name('images.txt.cache.npz').exists())
+
+            with unittest.mock.patch.object(ObjectDetectionLabelLoader, 'load', autospec=True) as load:
+                cached_dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True, use_cache=True)
+                self.assertEqual(load.call_count, 0)
+            self.assertEqual(list(cached_dataset), list(dataset))
+
+    def test_stream_creates_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 10)
+            dataset = SimpleDatasetFactory().load(main_txt_filepath, stream=True, use_cache=True)
+            self.assertFalse(main_txt_filepath.with_name('images.txt.cache.npz').exists())
+            entries = list(dataset)
+            self.assertTrue(main_txt_filepath.with_name('images.txt.cache.npz').exists())
+
+            with unittest.mock.patch.object(ObjectDetectionLabelLoader, 'load', autospec=True) as load:
+                cached_dataset = SimpleDatasetFactory().load(main_txt_filepath, stream=True, use_cache=True)
+                self.assertEqual(list(cached_dataset), entries)
+                self.assertEqual(load.call_count, 0)
+
+    def test_stream_reads_cache_by_chunk(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 25)
+            dataset = SimpleDatasetFactory().load(main_txt_filepath, use_cache=True)
+
+            dataset_type, stream = DatasetCache(main_txt_filepath).load(stream=True, chunk_size=7)
+            self.assertEqual(dataset_type, 'object_detection')
+            self.assertEqual(len(stream), 25)
+            self.assertEqual([len(chunk) for chunk in stream.iter_chunks()], [7, 7, 7, 4])
+            self.assertEqual(list(stream), list(dataset))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+from simpledataset.commands.sample import sample_images
+from simpledataset.common import DatasetWriter, SimpleDatasetFactory
+from tests.helpers import create_od_dataset
+
+
+class TestDatasetWriter(unittest.TestCase):
+    def test_link_images(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            main_txt_filepath = create_od_dataset(tempdir, 20)
+            dataset = sample_images(SimpleDatasetFactory().load(main_txt_filepath, lazy=True), 3, seed=0)
+            DatasetWriter().write(dataset, tempdir / 'output' / 'images.txt', copy_images=True, image_mode='link')
+
+            self.assertTrue((tempdir / 'output' / 'images.zip').samefile(tempdir / 'images.zip'))
+            self._assert_same_dataset(dataset, tempdir / 'output' / 'images.txt')
+
+    def test_link_images_copy_only_used_images(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            main_txt_filepath = create_od_dataset(tempdir, 20)
+            dataset = sample_images(SimpleDatasetFactory().load(main_txt_filepath, lazy=True), 3, seed=0)
+            with unittest.mock.patch('os.link', side_effect=OSError), unittest.mock.patch('simpledataset.common.dataset_writer._reflink_file', side_effect=OSError):
+                DatasetWriter().write(dataset, tempdir / 'output' / 'images.txt', copy_images=True, image_mode='link')
+
+            with zipfile.ZipFile(tempdir / 'output' / 'images.zip') as f:
+                self.assertEqual(len(f.namelist()), 3)
+            self._assert_same_dataset(dataset, tempdir / 'output' / 'images.txt')
+
+    def _assert_same_dataset(self, dataset, main_txt_filepath):
+        new_dataset = SimpleDatasetFactory().load(main_txt_filepath)
+        self.assertEqual([labels for _, labels in new_dataset], [labels for _, labels in dataset])
+        self.assertEqual([bytes(new_dataset.read_image_binary(image)) for image, _ in new_dataset],
+                         [bytes(dataset.read_image_binary(image)) for image, _ in dataset])
+
+
+if __name__ == '__main__':
+    unittest.main()
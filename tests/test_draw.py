@@ -0,0 +1,23 @@
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+from simpledataset.commands.draw import draw_dataset
+from simpledataset.common.dataset import ObjectDetectionLabelLoader
+from tests.helpers import create_od_dataset
+
+
+class TestDrawDataset(unittest.TestCase):
+    def test_decode_only_drawn_entries(self):
+        for labels_txt in (True, False):
+            with self.subTest(labels_txt=labels_txt), tempfile.TemporaryDirectory() as tempdir:
+                tempdir = pathlib.Path(tempdir)
+                main_txt_filepath = create_od_dataset(tempdir, 50, labels_txt=labels_txt)
+                with unittest.mock.patch.object(ObjectDetectionLabelLoader, 'load', autospec=True, side_effect=ObjectDetectionLabelLoader.load) as load:
+                    draw_dataset(main_txt_filepath, tempdir / 'output', limit=2, start=10)
+                    self.assertEqual(load.call_count, 2)
+                self.assertEqual(sorted(p.name for p in (tempdir / 'output').iterdir()), ['10.jpg', '11.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+import numpy as np
+from simpledataset.common.packed_label_file import PackedLabelFile
+
+
+class TestPackedLabelFile(unittest.TestCase):
+    def test_read_num_columns(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for num_columns in (5, 11):
+                filepath = pathlib.Path(tempdir) / f'labels{num_columns}.npz'
+                annotations = np.arange(num_columns * 3).reshape(3, num_columns)
+                PackedLabelFile.save(filepath, [0, 1, 3], annotations)
+
+                with unittest.mock.patch('numpy.load', side_effect=AssertionError("The arrays must not be loaded.")):
+                    self.assertEqual(PackedLabelFile.read_num_columns(filepath), num_columns)
+
+                packed_label_file = PackedLabelFile(filepath)
+                self.assertEqual(packed_label_file.num_columns, num_columns)
+                self.assertEqual(len(packed_label_file), 2)
+                np.testing.assert_array_equal(packed_label_file[1], annotations[1:3])
+
+
+if __name__ == '__main__':
+    unittest.main()
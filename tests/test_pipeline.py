@@ -0,0 +1,30 @@
+import pathlib
+import shlex
+import tempfile
+import unittest
+from simpledataset.commands.pipeline import _make_operation_parsers, run_pipeline
+from simpledataset.common import SimpleDatasetFactory
+from tests.helpers import create_od_dataset
+
+
+class TestRunPipeline(unittest.TestCase):
+    def test_missing_class_warning_once(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            main_txt_filepath = create_od_dataset(tempdir, 20)
+            output_filepath = tempdir / 'output' / 'images.txt'
+            parsers = _make_operation_parsers()
+            operations = []
+            for operation in ['filter --include_class 0 999', 'defrag', 'sample --num_images 5']:
+                tokens = shlex.split(operation)
+                operations.append((tokens[0], parsers[tokens[0]].parse_args(tokens[1:])))
+
+            with self.assertLogs('simpledataset.commands.filter', level='WARNING') as logs:
+                run_pipeline(main_txt_filepath, output_filepath, operations)
+
+            self.assertEqual(logs.output, ['WARNING:simpledataset.commands.filter:The class 999 is not in the dataset.'])
+            self.assertEqual(len(SimpleDatasetFactory().load(output_filepath)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+from simpledataset.commands.sample import sample_images
+from simpledataset.common import SimpleDatasetFactory
+from simpledataset.common.dataset import ObjectDetectionLabelLoader
+from tests.helpers import create_od_dataset
+
+
+class TestSampleImages(unittest.TestCase):
+    def test_lazy_dataset(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 50)
+            with unittest.mock.patch.object(ObjectDetectionLabelLoader, 'load', autospec=True, side_effect=ObjectDetectionLabelLoader.load) as load:
+                dataset = SimpleDatasetFactory().load(main_txt_filepath, lazy=True)
+                sampled = sample_images(dataset, 3, seed=0)
+                self.assertEqual(load.call_count, 3)
+
+            self.assertEqual(len(sampled), 3)
+            self.assertEqual(sampled.labels, ['a', 'b', 'c'])
+            all_entries = list(SimpleDatasetFactory().load(main_txt_filepath))
+            self.assertTrue(all(entry in all_entries for entry in sampled))
+
+    def test_same_samples_for_stream(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            main_txt_filepath = create_od_dataset(pathlib.Path(tempdir), 50)
+            lazy_sampled = sample_images(SimpleDatasetFactory().load(main_txt_filepath, lazy=True), 5, seed=1)
+            stream_sampled = sample_images(SimpleDatasetFactory().load(main_txt_filepath, stream=True), 5, seed=1)
+            self.assertEqual(list(lazy_sampled), list(stream_sampled))
+
+
+if __name__ == '__main__':
+    unittest.main()
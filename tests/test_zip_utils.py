@@ -0,0 +1,77 @@
+import pathlib
+import tempfile
+import unittest
+import zipfile
+from simpledataset.common.dataset_writer import ImageZipWriter
+from simpledataset.common.file_reader import FileReader
+from simpledataset.common.zip_utils import write_raw_entry
+
+_DATA = {'stored.jpg': (zipfile.ZIP_STORED, b'stored data' * 100),
+         'deflated.jpg': (zipfile.ZIP_DEFLATED, b'deflated data' * 100)}
+
+
+class TestWriteRawEntry(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            self._create_source_zip(tempdir / 'source.zip')
+            reader = FileReader(tempdir)
+            with zipfile.ZipFile(tempdir / 'new.zip', 'w') as zip_file:
+                zip_file.writestr('existing.txt', b'existing')
+                for name in _DATA:
+                    write_raw_entry(zip_file, 'new_' + name, *reader.read_raw(f'source.zip@{name}'))
+                zip_file.writestr('last.txt', b'last')
+
+            with zipfile.ZipFile(tempdir / 'new.zip') as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(zip_file.namelist(), ['existing.txt', 'new_stored.jpg', 'new_deflated.jpg', 'last.txt'])
+                for name, (compress_type, data) in _DATA.items():
+                    self.assertEqual(zip_file.getinfo('new_' + name).compress_type, compress_type)
+                    self.assertEqual(zip_file.read('new_' + name), data)
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            self._create_source_zip(tempdir / 'source.zip')
+            with zipfile.ZipFile(tempdir / 'new.zip', 'w') as zip_file:
+                zip_file.writestr('existing.txt', b'existing')
+
+            reader = FileReader(tempdir)
+            with zipfile.ZipFile(tempdir / 'new.zip', 'a') as zip_file:
+                for name in _DATA:
+                    write_raw_entry(zip_file, name, *reader.read_raw(f'source.zip@{name}'))
+
+            with zipfile.ZipFile(tempdir / 'new.zip') as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(zip_file.read('existing.txt'), b'existing')
+                for name, (_, data) in _DATA.items():
+                    self.assertEqual(zip_file.read(name), data)
+
+    def test_image_zip_writer_stores_all_images(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            self._create_source_zip(tempdir / 'source.zip')
+            reader = FileReader(tempdir)
+            output_dir = tempdir / 'output'
+            output_dir.mkdir()
+            for append in (False, True):
+                with ImageZipWriter(output_dir, append=append) as zip_writer:
+                    for name in _DATA:
+                        zip_writer.write_raw(name, *reader.read_raw(f'source.zip@{name}'))
+
+            with zipfile.ZipFile(output_dir / 'images.zip') as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(len(zip_file.namelist()), 4)
+                self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in zip_file.infolist()))
+                self.assertEqual(zip_file.read('deflated_0.jpg'), _DATA['deflated.jpg'][1])
+                self.assertEqual(zip_file.read('stored_0.jpg'), _DATA['stored.jpg'][1])
+
+    @staticmethod
+    def _create_source_zip(filepath):
+        with zipfile.ZipFile(filepath, 'w') as zip_file:
+            for name, (compress_type, data) in _DATA.items():
+                zip_file.writestr(name, data, compress_type=compress_type)
+
+
+if __name__ == '__main__':
+    unittest.main()